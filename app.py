@@ -1,11 +1,24 @@
 import os
 from flask import Flask
 from main.routes import main_bp
+from main.pdg_worker import pdg_worker
+from main.chat_log_journal import chat_log_journal
+from main.curriculum_index import curriculum_index
+from main.faq_index import faq_index
 
 def create_app():
     app = Flask(__name__)
     app.secret_key = os.environ.get("SECRET_KEY", "haruhi-dev-secret-2025")
     app.register_blueprint(main_bp)
+    # 前回未処理の PDG ジョブも拾えるよう起動時にワーカーを開始
+    pdg_worker.start()
+    # ライトビハインド有効時は前回送り切れなかったチャットログを送り直す
+    if chat_log_journal.is_enabled():
+        chat_log_journal.start()
+    # CURRICULUM_BACKEND=faiss の場合は学習指導要領索引を先読み
+    curriculum_index.load_async()
+    # さくらFAQ索引を先読み（数十行）
+    faq_index.load_async()
     return app
 
 app = create_app()
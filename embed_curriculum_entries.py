@@ -1,83 +1,288 @@
 # embed_curriculum_entries.py
 # =========================================
-# curriculum_entries 用 Embedding 生成（最終版）
+# curriculum_entries 用 Embedding 生成（バッチ版）
 # - embedding が NULL の行のみ対象
 # - 小学校／中学校／全教科共通
+# - 1リクエストで最大 BATCH_SIZE 件（トークン上限内）をまとめて埋め込む
+# - 同時実行数を制限し、429 のときだけ適応的にバックオフする
+# - 結果は bulk upsert で書き戻す（updated_at も更新し、索引の差分取得に載せる）
+# - id の keyset ページングで読み込み、バッチ完了ごとにチェックポイントを保存
+#   （中断しても --checkpoint から再開できる）
 # =========================================
 from dotenv import load_dotenv
 load_dotenv()
 
-from openai import OpenAI
 from supabase import create_client
 import os
+import json
 import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_service import embed_texts
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:   # tiktoken が無い環境では文字数で概算
+    _encoding = None
 
 
 # ===== 環境変数 =====
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 # ===== 初期化 =====
-client = OpenAI(api_key=OPENAI_API_KEY)
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # ===== 設定 =====
 TABLE_NAME = "curriculum_entries"
 TEXT_COLUMN = "content"
 EMBEDDING_COLUMN = "embedding"
+# 差分更新の基準列（main/curriculum_index.py と同じ）。行全体を書き戻すと古い値のまま
+# になり索引の差分取得に載らないため、書き戻し時に現在時刻を入れる
+SYNC_COLUMN = os.getenv("CURRICULUM_SYNC_COLUMN", "updated_at")
 
 EMBEDDING_MODEL = "text-embedding-3-small"
-SLEEP_SEC = 0.3   # レート制限対策（安全寄り）
 
-# ===== メイン処理 =====
-def generate_embeddings():
-    print("=== Embedding generation started ===")
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))              # 1リクエストの最大件数
+BATCH_TOKEN_BUDGET = int(os.getenv("EMBED_BATCH_TOKENS", "60000"))  # 1リクエストの最大トークン
+MAX_INPUT_TOKENS = 8191                                              # モデルの1入力上限
+CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))              # 同時リクエスト数
+PAGE_SIZE = int(os.getenv("EMBED_PAGE_SIZE", "500"))                # 1回に読み込む行数
+CHECKPOINT_PATH = ".embed_curriculum_checkpoint.json"
+MAX_RETRIES = 6
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is None:
+        return len(text)
+    return len(_encoding.encode(text))
+
+
+# ===== 429 適応バックオフ =====
+class AdaptiveBackoff:
+    """
+    全ワーカーで共有する待機時間。
+    429 を受けたら待機を倍増し、成功が続けば半減させる。
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self.resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            remaining = self.resume_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def on_rate_limited(self):
+        with self._lock:
+            self.delay = min(max(self.delay * 2, self.initial), self.maximum)
+            pause = self.delay * random.uniform(0.8, 1.2)
+            self.resume_at = max(self.resume_at, time.monotonic() + pause)
+            return pause
+
+    def on_success(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.initial else 0.0
+
+
+def _is_rate_limited(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 429
+
+
+# ===== バッチ分割 =====
+def make_batches(records):
+    """
+    件数（BATCH_SIZE）とトークン数（BATCH_TOKEN_BUDGET）の両方を満たすように分割する。
+    """
+    batches = []
+    current, current_tokens = [], 0
+
+    for record in records:
+        tokens = count_tokens(record[TEXT_COLUMN])
+        if tokens > MAX_INPUT_TOKENS:
+            print(f"[SKIP] id={record['id']} ({tokens} tokens > {MAX_INPUT_TOKENS})")
+            continue
+
+        if current and (len(current) >= BATCH_SIZE or current_tokens + tokens > BATCH_TOKEN_BUDGET):
+            batches.append(current)
+            current, current_tokens = [], 0
+
+        current.append(record)
+        current_tokens += tokens
+
+    if current:
+        batches.append(current)
+    return batches
 
-    response = (
+
+def embed_batch(batch, backoff: AdaptiveBackoff) -> int:
+    """
+    1バッチを埋め込み、bulk upsert で書き戻す。戻り値は書き込んだ件数。
+    """
+    texts = [r[TEXT_COLUMN] for r in batch]
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        backoff.wait()
+        try:
+            # 共通埋め込みサービス経由（再実行時はキャッシュから返る）
+            vectors = embed_texts(texts, model=EMBEDDING_MODEL)
+            backoff.on_success()
+            break
+        except Exception as e:
+            if not _is_rate_limited(e) or attempt == MAX_RETRIES:
+                raise
+            pause = backoff.on_rate_limited()
+            print(f"[429] backoff {pause:.1f}s (attempt {attempt})")
+
+    now = datetime.now(timezone.utc).isoformat()
+    rows = []
+    for record, vector in zip(batch, vectors):
+        row = dict(record)
+        row[EMBEDDING_COLUMN] = vector
+        if SYNC_COLUMN and SYNC_COLUMN in row:
+            row[SYNC_COLUMN] = now
+        rows.append(row)
+
+    supabase.table(TABLE_NAME).upsert(rows).execute()
+    return len(rows)
+
+
+# ===== チェックポイント =====
+def load_checkpoint(path: str, scope: dict):
+    """同じ対象範囲（scope）のチェックポイントがあれば最終 id を返す"""
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("scope") != scope:
+        print(f"[WARN] checkpoint scope differs ({data.get('scope')}), ignoring")
+        return None
+    return data.get("last_id")
+
+
+def save_checkpoint(path: str, scope: dict, last_id, done: int):
+    """一時ファイルに書いてから置き換える（書き込み途中で落ちても壊れない）"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(
+            {"scope": scope, "last_id": last_id, "done": done, "saved_at": time.time()},
+            f, ensure_ascii=False,
+        )
+    os.replace(tmp, path)
+
+
+# ===== ページ取得（keyset） =====
+def fetch_page(after_id, page_size: int, stage: str = None, subject: str = None):
+    """
+    embedding が NULL の行を id 昇順で after_id より後から page_size 件取得する。
+    upsert は行全体を書き戻すため全列を取得する。
+    """
+    query = (
         supabase
         .table(TABLE_NAME)
-        .select(f"id,{TEXT_COLUMN}")
+        .select("*")
         .is_(EMBEDDING_COLUMN, "null")
-        .execute()
     )
+    if stage:
+        query = query.eq("school_stage", stage)
+    if subject:
+        query = query.eq("subject", subject.upper())
+    if after_id is not None:
+        query = query.gt("id", after_id)
 
-    records = response.data
+    response = query.order("id").limit(page_size).execute()
+    return response.data or []
 
-    if not records:
-        print("No records to embed.")
-        return
 
-    total = len(records)
-    print(f"Target records: {total}")
+# ===== メイン処理 =====
+def generate_embeddings(
+    limit: int = None,
+    stage: str = None,
+    subject: str = None,
+    checkpoint_path: str = CHECKPOINT_PATH,
+    reset: bool = False,
+):
+    print("=== Embedding generation started ===")
+    started = time.monotonic()
 
-    for idx, record in enumerate(records, start=1):
-        record_id = record["id"]
-        text = record.get(TEXT_COLUMN)
+    scope = {"stage": stage, "subject": subject.upper() if subject else None}
+    after_id = None if reset else load_checkpoint(checkpoint_path, scope)
+    if after_id is not None:
+        print(f"Resume from checkpoint: id > {after_id}")
 
-        if not text or not text.strip():
-            print(f"[SKIP] {idx}/{total} id={record_id} (empty content)")
-            continue
+    backoff = AdaptiveBackoff()
+    scanned = 0
+    done = 0
+    failed = 0
+    checkpoint_frozen = False   # 失敗バッチ以降はチェックポイントを進めない
 
-        try:
-            embedding = client.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input=text
-            ).data[0].embedding
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        while limit is None or scanned < limit:
+            page_size = PAGE_SIZE if limit is None else min(PAGE_SIZE, limit - scanned)
+            records = fetch_page(after_id, page_size, stage=stage, subject=subject)
+            if not records:
+                break
 
-            supabase.table(TABLE_NAME).update(
-                {EMBEDDING_COLUMN: embedding}
-            ).eq("id", record_id).execute()
+            scanned += len(records)
+            page_last_id = records[-1]["id"]
 
-            print(f"[OK] {idx}/{total} id={record_id}")
-            time.sleep(SLEEP_SEC)
+            targets = []
+            for record in records:
+                text = record.get(TEXT_COLUMN)
+                if not text or not text.strip():
+                    print(f"[SKIP] id={record['id']} (empty content)")
+                    continue
+                targets.append(record)
 
-        except Exception as e:
-            print(f"[ERROR] {idx}/{total} id={record_id} : {e}")
-            time.sleep(1)
+            batches = make_batches(targets)
+            futures = [executor.submit(embed_batch, b, backoff) for b in batches]
+
+            # 先頭から連続して完了したバッチの末尾までチェックポイントを進める
+            for batch, future in zip(batches, futures):
+                try:
+                    done += future.result()
+                    print(f"[OK] {done} rows (scanned {scanned})")
+                    if not checkpoint_frozen:
+                        save_checkpoint(checkpoint_path, scope, batch[-1]["id"], done)
+                except Exception as e:
+                    failed += len(batch)
+                    checkpoint_frozen = True
+                    print(f"[ERROR] batch ids={batch[0]['id']}..{batch[-1]['id']} : {e}")
+
+            # 空行・上限超過のみのページでも位置は進める
+            if not checkpoint_frozen:
+                save_checkpoint(checkpoint_path, scope, page_last_id, done)
+            after_id = page_last_id
 
-    print("=== Embedding generation finished ===")
+    elapsed = time.monotonic() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"=== Embedding generation finished: {done} rows, {failed} failed, "
+          f"{elapsed:.1f}s ({rate:.1f} rows/s) ===")
 
 # ===== 実行 =====
 if __name__ == "__main__":
-    generate_embeddings()
+    parser = argparse.ArgumentParser(description="curriculum_entries の embedding を生成する")
+    parser.add_argument("--limit", type=int, default=None, help="今回処理する最大行数")
+    parser.add_argument("--stage", default=None, help="school_stage で絞り込み（例：junior_high）")
+    parser.add_argument("--subject", default=None, help="subject で絞り込み（例：SCIENCE）")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="チェックポイントファイル")
+    parser.add_argument("--reset", action="store_true", help="チェックポイントを無視して先頭から")
+    args = parser.parse_args()
+
+    generate_embeddings(
+        limit=args.limit,
+        stage=args.stage,
+        subject=args.subject,
+        checkpoint_path=args.checkpoint,
+        reset=args.reset,
+    )
@@ -0,0 +1,210 @@
+# embedding_service.py
+"""
+HARUHI - 埋め込み生成サービス（共通）
+すべての embedding 生成（HARUHI RAG / さくらFAQ / PDG / 指導要領の埋め込みスクリプト）は
+このモジュールを経由する。
+
+- キャッシュキー：(モデル名, 正規化テキストの sha256)
+- ベクトルは float32 のバイト列としてローカル SQLite（WAL）に保存する。
+  gunicorn の複数ワーカー・バッチスクリプトから同じファイルを共有できる。
+- 合計サイズが EMBED_CACHE_MAX_MB を超えたら最終参照が古いものから削除する。
+"""
+
+import os
+import time
+import hashlib
+from array import array
+from typing import List
+
+from dotenv import load_dotenv
+
+from local_store import SqliteConnections, default_path
+from text_normalize import normalize_text
+from openai_client import get_openai, EMBED_TIMEOUT
+
+load_dotenv()
+
+EMBED_MODEL = "text-embedding-3-small"   # JEISI標準（1536次元）
+
+# === キャッシュ設定 ===
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE", "1") != "0"
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", default_path("haruhi_embed_cache.sqlite3"))
+EMBED_CACHE_MAX_BYTES = int(float(os.getenv("EMBED_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+EVICT_CHECK_EVERY = 200      # 何件書き込むごとにサイズ確認するか
+TOUCH_INTERVAL_SEC = 3600    # 最終参照時刻の更新間隔（書き込み競合を減らす）
+
+
+def cache_key(text: str, model: str = EMBED_MODEL) -> str:
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{model}:{digest}"
+
+
+# --------------------------------------
+# SQLite 埋め込みキャッシュ
+# --------------------------------------
+class EmbeddingCache:
+
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_bytes: int = EMBED_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._db = SqliteConnections(path)
+        self._writes = 0
+        with self._db.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key         TEXT PRIMARY KEY,
+                    vec         BLOB NOT NULL,
+                    size        INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_embeddings_access ON embeddings (last_access)"
+            )
+
+    def get_many(self, keys: List[str]) -> dict:
+        if not keys:
+            return {}
+        found = {}
+        stale = []
+        now = time.time()
+        placeholders = ",".join("?" * len(keys))
+        with self._db.connection() as conn:
+            for key, blob, last_access in conn.execute(
+                f"SELECT key, vec, last_access FROM embeddings WHERE key IN ({placeholders})",
+                keys,
+            ):
+                vec = array("f")
+                vec.frombytes(blob)
+                found[key] = vec.tolist()
+                if last_access < now - TOUCH_INTERVAL_SEC:
+                    stale.append(key)
+
+            if stale:
+                conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, k) for k in stale],
+                )
+        return found
+
+    def put_many(self, items: dict):
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items.items():
+            blob = array("f", vec).tobytes()
+            rows.append((key, blob, len(blob), now))
+
+        with self._db.connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vec, size, last_access) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+        self._writes += len(rows)
+        if self._writes >= EVICT_CHECK_EVERY:
+            self._writes = 0
+            self.evict()
+
+    def evict(self):
+        """合計サイズが上限を超えていれば古いものから削除し 9 割まで減らす"""
+        with self._db.connection() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        target = int(self.max_bytes * 0.9)
+        with self._db.transaction() as conn:
+            removed = 0
+            rows = conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_access"
+            ).fetchall()
+            doomed = []
+            for key, size in rows:
+                if total - removed <= target:
+                    break
+                doomed.append((key,))
+                removed += size
+            conn.executemany("DELETE FROM embeddings WHERE key = ?", doomed)
+        print(f"[INFO] embedding cache evicted {len(doomed)} entries ({removed} bytes)")
+
+
+_cache = None
+
+
+def _get_cache():
+    global _cache
+    if not EMBED_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        try:
+            _cache = EmbeddingCache()
+        except Exception as e:
+            print("[ERROR] embedding cache init:", e)
+            return None
+    return _cache
+
+
+# --------------------------------------
+# 公開 API
+# --------------------------------------
+def embed_texts(texts: List[str], model: str = EMBED_MODEL) -> List[list]:
+    """
+    複数テキストをまとめて埋め込む。
+    キャッシュにないものだけを1回の API 呼び出しで生成する（入力順を保持）。
+    """
+    if not texts:
+        return []
+
+    keys = [cache_key(t, model) for t in texts]
+    cache = _get_cache()
+
+    found = {}
+    if cache is not None:
+        try:
+            found = cache.get_many(list(set(keys)))
+        except Exception as e:
+            print("[ERROR] embedding cache read:", e)
+
+    # 未キャッシュ分（同一キーは1回だけ生成）
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in missing:
+            missing[key] = text
+
+    if missing:
+        response = get_openai().embeddings.create(
+            model=model,
+            input=list(missing.values()),
+            timeout=EMBED_TIMEOUT,
+        )
+        generated = {
+            key: item.embedding
+            for key, item in zip(missing.keys(), sorted(response.data, key=lambda d: d.index))
+        }
+        found.update(generated)
+
+        if cache is not None:
+            try:
+                cache.put_many(generated)
+            except Exception as e:
+                print("[ERROR] embedding cache write:", e)
+
+    return [found[k] for k in keys]
+
+
+def embed_text(text: str, model: str = EMBED_MODEL) -> list:
+    """1テキストの埋め込み（キャッシュ経由）"""
+    return embed_texts([text], model=model)[0]
+
+
+if __name__ == "__main__":
+    # 動作確認（2回目はキャッシュから返る）
+    for _ in range(2):
+        start = time.time()
+        vec = embed_text("小学校理科の見方・考え方とは？")
+        print(f"dim={len(vec)}  {time.time() - start:.3f}s")
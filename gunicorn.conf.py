@@ -0,0 +1,47 @@
+# gunicorn.conf.py
+# =========================================
+# HARUHI - gunicorn 設定
+# - 既定は gevent ワーカー：LLM 応答待ち（数秒〜）の間も同じワーカーで
+#   他の教員のリクエストを処理できる
+# - GUNICORN_WORKER_CLASS=gthread でスレッドワーカーにも切り替え可能
+#   （gevent が使えない環境向け）
+# - 起動：gunicorn -c gunicorn.conf.py app:app
+#
+# 注意：このファイルは master プロセスで読み込まれるため、
+#       アプリのモジュール（openai / supabase など）は import しない。
+#       gevent の monkey patch はワーカー起動時に gunicorn が行う。
+# =========================================
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(2 * multiprocessing.cpu_count() + 1, 4))))
+
+# 1ワーカーあたりの同時接続数（gevent）／スレッド数（gthread）
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+# SSE ストリーミングと LLM 待ちを考慮してタイムアウトを長めにする
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# ワーカーごとに monkey patch 後にアプリを読み込む（preload すると patch 前の
+# socket / ssl を掴んだままになる）
+preload_app = False
+
+# メモリ断片化対策として一定リクエストごとにワーカーを入れ替える
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = 100
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+# OpenAI の接続プールを同時処理数に合わせる（ワーカー側で読まれる）
+_per_worker = worker_connections if worker_class == "gevent" else threads
+os.environ.setdefault("OPENAI_POOL_MAX", str(_per_worker))
+os.environ.setdefault("OPENAI_POOL_KEEPALIVE", str(min(_per_worker, 32)))
+os.environ.setdefault("HARUHI_FANOUT_WORKERS", str(max(16, _per_worker)))
@@ -0,0 +1,107 @@
+# load_test_chat.py
+# =========================================
+# /haruhi_chat 同時実行ロードテスト
+# - N 人の教員が同時に送信した状況を再現し、レイテンシと実効同時実行数を出す
+# - 実効同時実行数 = 全リクエストの処理時間の合計 ÷ 経過時間
+#   sync ワーカーでは workers 数で頭打ちになり、gevent / gthread では
+#   それを超えて伸びることを確認する
+#
+# 例：
+#   gunicorn -c gunicorn.conf.py app:app
+#   python load_test_chat.py --url http://localhost:8000 --session <id> \
+#       --token <access_token> --concurrency 16 --requests 64
+# =========================================
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SAMPLE_MESSAGES = [
+    "小学校理科の電気の単元で、子どもが問いを持つ導入は？",
+    "中学校数学の関数で、変化の割合をどう考えさせればよい？",
+    "国語で自分の考えを書く活動の評価はどうする？",
+    "植物の成長を調べる観察記録の工夫は？",
+]
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = requests.Session()
+        _local.session = s
+    return s
+
+
+def send_chat(url: str, session_id: str, token: str, message: str, timeout: float):
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    start = time.monotonic()
+    try:
+        res = _session().post(
+            f"{url.rstrip('/')}/haruhi_chat",
+            json={"message": message, "session_id": session_id},
+            headers=headers,
+            timeout=timeout,
+        )
+        ok = res.status_code == 200
+        status = res.status_code
+    except Exception as e:
+        ok = False
+        status = type(e).__name__
+    return ok, status, time.monotonic() - start
+
+
+def _percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(url: str, session_id: str, token: str, concurrency: int, total: int, timeout: float):
+    print(f"=== load test: {total} requests, concurrency={concurrency} ===")
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                send_chat, url, session_id, token,
+                SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)], timeout,
+            )
+            for i in range(total)
+        ]
+        results = [f.result() for f in futures]
+
+    elapsed = time.monotonic() - started
+    latencies = [lat for ok, _, lat in results if ok]
+    errors = [status for ok, status, _ in results if not ok]
+    busy = sum(lat for _, _, lat in results)
+
+    print(f"ok={len(latencies)} error={len(errors)} elapsed={elapsed:.1f}s "
+          f"throughput={len(results) / elapsed:.2f} req/s")
+    print(f"latency p50={_percentile(latencies, 50):.2f}s "
+          f"p90={_percentile(latencies, 90):.2f}s "
+          f"p99={_percentile(latencies, 99):.2f}s")
+    print(f"effective concurrency={busy / elapsed:.1f}")
+    if errors:
+        print("errors:", sorted(set(map(str, errors))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/haruhi_chat の同時実行ロードテスト")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--session", required=True, help="送信先の session_id")
+    parser.add_argument("--token", default="", help="Supabase のアクセストークン")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    run(args.url, args.session, args.token, args.concurrency, args.requests, args.timeout)
@@ -0,0 +1,137 @@
+# local_store.py
+"""
+HARUHI - ローカル SQLite 共通ヘルパー
+PDGジョブキュー・埋め込みキャッシュなど、gunicorn の複数ワーカーで
+共有するローカルファイルの接続管理をまとめる。
+キャッシュ無効化を全ワーカーに伝える世代番号（shared_versions）もここに置く。
+
+- 接続はファイルごとに1プロセス1本。ロックで1度に1つのスレッド（gevent では
+  グリーンレット）だけが使う。スレッドごとに張ると gevent ではリクエストごとに
+  接続が増え続け、PRAGMA も毎回走るため
+- fork 後の子プロセスでは接続とロックを作り直す
+- WAL モードで読み書きの同時実行を許可する
+- 他ワーカーのロック待ち（busy timeout）は短くする。待っている間は
+  gevent のハブごと止まるため
+"""
+
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# 他プロセスが書き込み中のときに待つ最大秒数
+BUSY_TIMEOUT_SEC = float(os.getenv("HARUHI_SQLITE_BUSY_TIMEOUT", "2"))
+
+
+def default_path(filename: str) -> str:
+    """既定の保存先（OS の一時ディレクトリ）"""
+    return os.path.join(tempfile.gettempdir(), filename)
+
+
+class SqliteConnections:
+    """
+    使い方：
+        db = SqliteConnections(path)
+        with db.connection() as conn:
+            conn.execute("...")
+        with db.transaction() as conn:     # BEGIN IMMEDIATE 〜 COMMIT
+            conn.execute("...")
+
+    with の中ではロックを持っているので、ネットワーク I/O などの遅い処理はしないこと。
+    """
+
+    def __init__(
+        self, path: str, timeout: float = BUSY_TIMEOUT_SEC, synchronous: str = "NORMAL"
+    ):
+        self.path = path
+        self.timeout = timeout
+        # 取りこぼせないデータ（チャットログのジャーナル）は "FULL" を指定する
+        self.synchronous = synchronous
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def _reset_after_fork(self):
+        if self._pid != os.getpid():
+            # 親プロセスの接続・ロックは引き継がない
+            self._lock = threading.RLock()
+            self._conn = None
+            self._pid = os.getpid()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """プロセス共有の接続をロックを持った状態で渡す"""
+        self._reset_after_fork()
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._open()
+            yield self._conn
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE で書き込みトランザクションを張る（例外なら ROLLBACK）"""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+
+class SharedVersions:
+    """
+    名前ごとの世代番号を複数ワーカーで共有する（キャッシュの無効化通知用）。
+    無効化した側が bump() し、各ワーカーは読み込み時の世代と get() を比べて
+    古ければ読み直す。読み込み中に bump されても次の比較で検出できる。
+
+    使い方：
+        versions.bump("haruhi_faqs")
+        if versions.get("haruhi_faqs") != snapshot.generation: ...
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = SqliteConnections(path)
+        with self._db.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS versions ("
+                " name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    def get(self, name: str) -> int:
+        with self._db.connection() as conn:
+            row = conn.execute(
+                "SELECT value FROM versions WHERE name = ?", (name,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name: str) -> int:
+        with self._db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO versions (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+            row = conn.execute(
+                "SELECT value FROM versions WHERE name = ?", (name,)
+            ).fetchone()
+        return row[0]
+
+
+shared_versions = SharedVersions(
+    os.getenv("HARUHI_VERSIONS_PATH", default_path("haruhi_versions.sqlite3"))
+)
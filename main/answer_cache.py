@@ -0,0 +1,150 @@
+# ============================================
+#  HARUHI：意味的回答キャッシュ
+# ============================================
+"""
+ほぼ同じ問い（例：「小学校理科の見方・考え方とは？」）に対する
+RAG + gpt-4o の回答を再利用するためのキャッシュ。
+
+- 検索条件キー：(校種, 教科, 取得した指導要領 id の集合)
+  根拠が同じ場合だけ候補にする（根拠が変われば回答も変わる）
+- 候補の中でクエリ embedding のコサイン類似度が閾値以上なら命中
+- 件数上限つき LRU + TTL
+- invalidate() は共有の世代番号（local_store.shared_versions）を進め、
+  全ワーカーのキャッシュを次回参照時に破棄させる
+- 会話履歴にユーザー発話（直近の問い・PDG系譜）がある場合は呼び出し側で使わない
+  （セッション冒頭の挨拶だけなら使う）
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from local_store import shared_versions
+
+ANSWER_CACHE_ENABLED = os.getenv("HARUHI_ANSWER_CACHE", "1") != "0"
+ANSWER_CACHE_SIZE = int(os.getenv("HARUHI_ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("HARUHI_ANSWER_CACHE_TTL", "21600"))          # 秒
+ANSWER_CACHE_THRESHOLD = float(os.getenv("HARUHI_ANSWER_CACHE_THRESHOLD", "0.95"))
+VERSION_KEY = "haruhi_answer_cache"
+
+
+def evidence_key(meta: Dict[str, Any]) -> tuple:
+    """retrieve() の meta から検索条件キーを作る"""
+    ids = frozenset(
+        c.get("id") for c in meta.get("curriculum") or [] if c.get("id") is not None
+    )
+    return meta.get("stage"), meta.get("subject"), ids
+
+
+def _unit(vector) -> Optional[np.ndarray]:
+    vec = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vec))
+    if norm == 0.0:
+        return None
+    return vec / norm
+
+
+class SemanticAnswerCache:
+    """
+    使い方：
+        reply = answer_cache.get(query_vec, meta)
+        ...
+        answer_cache.set(query_vec, meta, reply)
+    """
+
+    def __init__(
+        self,
+        maxsize: int = ANSWER_CACHE_SIZE,
+        ttl: float = ANSWER_CACHE_TTL,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()   # entry_id -> (key, expires_at, unit_vec, reply)
+        self._buckets = {}              # key -> [entry_id, ...]
+        self._next_id = 0
+        self._generation = shared_versions.get(VERSION_KEY)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, entry_id: int):
+        key = self._entries.pop(entry_id)[0]
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.remove(entry_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def _sync_generation(self):
+        """他ワーカーで invalidate() されていれば手元の分を破棄する（ロック内で呼ぶ）"""
+        generation = shared_versions.get(VERSION_KEY)
+        if generation != self._generation:
+            self._entries.clear()
+            self._buckets.clear()
+            self._generation = generation
+
+    def get(self, query_vec: List[float], meta: Dict[str, Any]) -> Optional[str]:
+        unit = _unit(query_vec)
+        if unit is None:
+            return None
+        key = evidence_key(meta)
+        now = time.monotonic()
+
+        with self._lock:
+            self._sync_generation()
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._buckets.get(key, ())):
+                _, expires_at, cached_vec, _ = self._entries[entry_id]
+                if expires_at < now:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(unit, cached_vec))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id][3]
+
+    def set(self, query_vec: List[float], meta: Dict[str, Any], reply: str):
+        if self.maxsize <= 0:
+            return
+        unit = _unit(query_vec)
+        if unit is None:
+            return
+        key = evidence_key(meta)
+
+        with self._lock:
+            self._sync_generation()
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (key, time.monotonic() + self.ttl, unit, reply)
+            self._buckets.setdefault(key, []).append(entry_id)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def invalidate(self):
+        """根拠（学習指導要領）を更新したときに呼ぶ。全ワーカーのキャッシュを破棄する"""
+        shared_versions.bump(VERSION_KEY)
+        self.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,274 @@
+# ============================================
+#  HARUHI：Bearer トークン検証（ローカル検証 + キャッシュ）
+# ============================================
+"""
+Supabase Auth のアクセストークン（JWT）から user_id を取り出す。
+
+1) 検証済みトークンのキャッシュ（有効期限つき LRU）
+2) ローカル検証
+   - SUPABASE_JWT_SECRET があれば HS256 を標準ライブラリで検証
+   - 非対称鍵（RS256 / ES256）のトークンは PyJWT が入っていれば JWKS で検証
+3) どちらもできない場合のみ Supabase の /auth/v1/user に問い合わせる
+   （requests.Session で接続を再利用し、タイムアウトを設定）
+"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+try:
+    import jwt as pyjwt          # 任意依存（JWKS 検証用）
+except ImportError:
+    pyjwt = None
+
+load_dotenv()
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUD", "authenticated")
+
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "4096"))
+REMOTE_VERIFY_TTL = float(os.getenv("AUTH_REMOTE_VERIFY_TTL", "300"))   # 秒
+REMOTE_TIMEOUT = (3.05, 5)       # (接続, 読み込み) 秒
+CLOCK_SKEW = 30                  # exp 判定の許容誤差（秒）
+
+
+def _b64url_decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def _decode_unverified(token: str):
+    """署名検証なしで (header, payload) を取り出す。形式不正なら None"""
+    try:
+        header_b64, payload_b64, _ = token.split(".")
+        header = json.loads(_b64url_decode(header_b64))
+        payload = json.loads(_b64url_decode(payload_b64))
+        return header, payload
+    except Exception:
+        return None
+
+
+# --------------------------------------
+# 検証済みトークンのキャッシュ
+# --------------------------------------
+class TokenCache:
+    """
+    トークンの sha256 → (user_id, 失効時刻) の LRU。
+    失効時刻を過ぎたエントリは返さない。
+    """
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, token: str):
+        key = self._key(token)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            user_id, expires_at = item
+            if expires_at <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return user_id
+
+    def set(self, token: str, user_id: str, expires_at: float):
+        key = self._key(token)
+        with self._lock:
+            self._data[key] = (user_id, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# --------------------------------------
+# ローカル検証
+# --------------------------------------
+def _check_claims(payload: dict) -> bool:
+    now = time.time()
+    exp = payload.get("exp")
+    if exp is None or exp + CLOCK_SKEW < now:
+        return False
+    nbf = payload.get("nbf")
+    if nbf is not None and nbf - CLOCK_SKEW > now:
+        return False
+    aud = payload.get("aud")
+    if JWT_AUDIENCE and aud is not None:
+        auds = aud if isinstance(aud, list) else [aud]
+        if JWT_AUDIENCE not in auds:
+            return False
+    return bool(payload.get("sub"))
+
+
+def _verify_hs256(token: str, payload: dict) -> bool:
+    signing_input, _, signature = token.rpartition(".")
+    expected = hmac.new(
+        SUPABASE_JWT_SECRET.encode("utf-8"),
+        signing_input.encode("ascii"),
+        hashlib.sha256,
+    ).digest()
+    try:
+        actual = _b64url_decode(signature)
+    except Exception:
+        return False
+    return hmac.compare_digest(expected, actual)
+
+
+_jwks_client = None
+
+
+def _verify_jwks(token: str):
+    """
+    署名が正しければ True、署名・クレーム不正なら False。
+    鍵を取得できない（JWKS の取得失敗・未知の kid）場合は None を返し、
+    リモート検証に回す（JWKS 障害や鍵ローテーションで全員 401 にしない）。
+    """
+    global _jwks_client
+    try:
+        if _jwks_client is None:
+            _jwks_client = pyjwt.PyJWKClient(
+                f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json", cache_keys=True
+            )
+        signing_key = _jwks_client.get_signing_key_from_jwt(token)
+    except Exception as e:
+        print("[WARN] JWKS key lookup failed, falling back to remote verify:", e)
+        return None
+
+    try:
+        pyjwt.decode(
+            token,
+            signing_key.key,
+            algorithms=["RS256", "ES256"],
+            audience=JWT_AUDIENCE or None,
+            leeway=CLOCK_SKEW,
+        )
+    except pyjwt.InvalidTokenError as e:
+        print("[WARN] JWKS verify failed:", e)
+        return False
+    except Exception as e:
+        print("[WARN] JWKS verify error, falling back to remote verify:", e)
+        return None
+    return True
+
+
+def verify_locally(token: str):
+    """
+    ローカルで検証できれば (user_id, exp) を返す。
+    検証できない（鍵がない・形式不明）場合は None、署名不正は False。
+    """
+    decoded = _decode_unverified(token)
+    if decoded is None:
+        return False
+    header, payload = decoded
+    alg = header.get("alg")
+
+    if alg == "HS256" and SUPABASE_JWT_SECRET:
+        if not _verify_hs256(token, payload) or not _check_claims(payload):
+            return False
+        return payload["sub"], float(payload["exp"])
+
+    if alg in ("RS256", "ES256") and pyjwt is not None and SUPABASE_URL:
+        verified = _verify_jwks(token)
+        if verified is None:
+            return None
+        if not verified or not _check_claims(payload):
+            return False
+        return payload["sub"], float(payload["exp"])
+
+    return None
+
+
+# --------------------------------------
+# リモート検証（フォールバック）
+# --------------------------------------
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    """接続を再利用する requests.Session（fork 後は作り直す）"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+def verify_remotely(token: str):
+    res = _get_session().get(
+        f"{SUPABASE_URL}/auth/v1/user",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "apikey": SUPABASE_KEY,
+        },
+        timeout=REMOTE_TIMEOUT,
+    )
+    if res.status_code != 200:
+        return None
+    return res.json().get("id")
+
+
+# --------------------------------------
+# 公開 API
+# --------------------------------------
+_token_cache = TokenCache()
+
+
+def verify_bearer_token(token: str):
+    """
+    アクセストークンを検証して user_id を返す。不正・期限切れなら None。
+    """
+    if not token:
+        return None
+
+    cached = _token_cache.get(token)
+    if cached is not None:
+        return cached
+
+    local = verify_locally(token)
+    if local is False:
+        return None
+    if local is not None:
+        user_id, exp = local
+        _token_cache.set(token, user_id, exp)
+        return user_id
+
+    # ローカル検証できない場合のみ Supabase に問い合わせる
+    try:
+        user_id = verify_remotely(token)
+    except Exception as e:
+        print("[ERROR] auth remote verify:", e)
+        return None
+    if not user_id:
+        return None
+
+    # リモート検証結果は短めに保持（トークン自体の exp を超えない）
+    expires_at = time.time() + REMOTE_VERIFY_TTL
+    decoded = _decode_unverified(token)
+    if decoded is not None and decoded[1].get("exp"):
+        expires_at = min(expires_at, float(decoded[1]["exp"]))
+    _token_cache.set(token, user_id, expires_at)
+    return user_id
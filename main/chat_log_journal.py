@@ -0,0 +1,256 @@
+# ============================================
+#  HARUHI：チャットログのライトビハインド・ジャーナル
+# ============================================
+"""
+haruhi_chat_logs への書き込みをリクエストから切り離すための追記専用ジャーナル。
+
+- append() は行をローカル SQLite（WAL, synchronous=FULL）に追記した時点で返る。
+- フラッシャースレッドが古い順にまとめて haruhi_chat_logs へ insert する。
+  失敗したら指数バックオフで再試行し、成功した行だけジャーナルから消す。
+- プロセスが落ちても行はファイルに残り、次に start() したワーカーが送り直す。
+  送信済み・削除前に落ちた行は id の重複を無視する upsert で二重登録を防ぐ。
+- gunicorn の複数ワーカーが同じファイルを共有しても、
+  各行は1プロセスだけが取得（claim）して送る。
+- pending_rows() で未送信の行を読めるので、読み出し側は DB の結果に
+  マージして直近の発話を表示できる。
+
+環境変数 CHAT_LOG_WRITE_BEHIND=1 で有効化（既定は従来どおり同期 insert）。
+Render などディスクが再デプロイで消える環境では CHAT_LOG_JOURNAL_PATH を
+永続ディスク上に置くこと。
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from typing import Any, Dict, List
+
+from supabase_client import supabase
+from local_store import SqliteConnections, default_path
+
+# === 設定 ===
+CHAT_LOG_WRITE_BEHIND = os.getenv("CHAT_LOG_WRITE_BEHIND", "0") == "1"
+JOURNAL_PATH = os.getenv(
+    "CHAT_LOG_JOURNAL_PATH", default_path("haruhi_chat_journal.sqlite3")
+)
+FLUSH_INTERVAL = float(os.getenv("CHAT_LOG_FLUSH_SEC", "0.5"))
+FLUSH_BATCH = int(os.getenv("CHAT_LOG_FLUSH_BATCH", "200"))
+MAX_BACKOFF_SEC = 300
+STALE_LOCK_SEC = 120     # これ以上 claim されたままなら落ちたとみなして送り直す
+
+TABLE_NAME = "haruhi_chat_logs"
+
+# 更新時刻列（/get_pdg_tree の since= が使う）。送信時刻で上書きし、
+# 追記から送信までの間に since= を取ったクライアントにも新しい行が届くようにする。
+# 列がない DB では初回失敗時に外して送り直す
+PDG_SYNC_COLUMN = os.getenv("PDG_SYNC_COLUMN", "updated_at")
+
+
+class ChatLogJournal:
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        self.path = path
+        self._db = SqliteConnections(path, synchronous="FULL")
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._sync_column = PDG_SYNC_COLUMN or None
+        self._init_schema()
+
+    def _fetch(self, sql: str, params=()):
+        with self._db.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def _init_schema(self):
+        with self._db.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_log_journal (
+                    seq          INTEGER PRIMARY KEY AUTOINCREMENT,
+                    row_id       TEXT    NOT NULL UNIQUE,
+                    session_id   TEXT,
+                    payload      TEXT    NOT NULL,
+                    attempts     INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL    NOT NULL,
+                    locked_at    REAL,
+                    last_error   TEXT
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chat_log_journal_session "
+                "ON chat_log_journal (session_id, seq)"
+            )
+
+    def is_enabled(self) -> bool:
+        return CHAT_LOG_WRITE_BEHIND
+
+    # ================================
+    # 書き込み側
+    # ================================
+    def append(self, rows: List[Dict[str, Any]]):
+        """行を1トランザクションで追記する（ここで返れば保存済みとして扱う）"""
+        now = time.time()
+        with self._db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO chat_log_journal "
+                "(row_id, session_id, payload, available_at) VALUES (?, ?, ?, ?)",
+                [
+                    (r["id"], r.get("session_id"), json.dumps(r, ensure_ascii=False), now)
+                    for r in rows
+                ],
+            )
+        self.start()
+        self._wakeup.set()
+
+    # ================================
+    # 読み出し側
+    # ================================
+    def pending_rows(self, session_id: str) -> List[Dict[str, Any]]:
+        """セッションの未送信行（追記順）"""
+        rows = self._fetch(
+            "SELECT payload FROM chat_log_journal WHERE session_id = ? ORDER BY seq",
+            (session_id,),
+        )
+        return [json.loads(r[0]) for r in rows]
+
+    def holds(self, row_id: str) -> bool:
+        """row_id がまだ DB に送られていなければ True"""
+        rows = self._fetch(
+            "SELECT 1 FROM chat_log_journal WHERE row_id = ?", (row_id,)
+        )
+        return bool(rows)
+
+    def pending_count(self) -> int:
+        return self._fetch("SELECT COUNT(*) FROM chat_log_journal")[0][0]
+
+    # ================================
+    # フラッシャー
+    # ================================
+    def _claim(self) -> List[Dict[str, Any]]:
+        """送信可能な行を最大 FLUSH_BATCH 件取得して claim する"""
+        now = time.time()
+        with self._db.transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, payload, attempts FROM chat_log_journal "
+                "WHERE available_at <= ? AND (locked_at IS NULL OR locked_at < ?) "
+                "ORDER BY seq LIMIT ?",
+                (now, now - STALE_LOCK_SEC, FLUSH_BATCH),
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE chat_log_journal SET locked_at = ? WHERE seq = ?",
+                    [(now, r[0]) for r in rows],
+                )
+        return [
+            {"seq": r[0], "row": json.loads(r[1]), "attempts": r[2] + 1}
+            for r in rows
+        ]
+
+    def _done(self, entries: List[Dict[str, Any]]):
+        with self._db.connection() as conn:
+            conn.executemany(
+                "DELETE FROM chat_log_journal WHERE seq = ?",
+                [(e["seq"],) for e in entries],
+            )
+
+    def _retry(self, entries: List[Dict[str, Any]], error: str):
+        """指数バックオフで再送を予約する（チャットログは捨てない）"""
+        now = time.time()
+        with self._db.connection() as conn:
+            conn.executemany(
+                "UPDATE chat_log_journal SET locked_at = NULL, attempts = ?, "
+                "available_at = ?, last_error = ? WHERE seq = ?",
+                [
+                    (e["attempts"], now + min(2 ** e["attempts"], MAX_BACKOFF_SEC), error, e["seq"])
+                    for e in entries
+                ],
+            )
+
+    def _upsert(self, rows: List[Dict[str, Any]]):
+        (
+            supabase.table(TABLE_NAME)
+            .upsert(rows, on_conflict="id", ignore_duplicates=True)
+            .execute()
+        )
+
+    def _send(self, entries: List[Dict[str, Any]]):
+        column = self._sync_column
+        rows = [dict(e["row"]) for e in entries]
+        if column is None:
+            for row in rows:
+                row.pop(PDG_SYNC_COLUMN, None)
+            self._upsert(rows)
+            return
+
+        sent_at = datetime.utcnow().isoformat()
+        for row in rows:
+            if column in row:
+                row[column] = sent_at
+        try:
+            self._upsert(rows)
+        except Exception as e:
+            if column not in str(e):
+                raise
+            print(f"[WARN] chat log flush: {TABLE_NAME}.{column} not available, dropped:", e)
+            self._sync_column = None
+            for row in rows:
+                row.pop(column, None)
+            self._upsert(rows)
+
+    def flush(self) -> int:
+        """1バッチ分を送信する。送信できた行数を返す"""
+        entries = self._claim()
+        if not entries:
+            return 0
+        try:
+            self._send(entries)
+            self._done(entries)
+            return len(entries)
+        except Exception as e:
+            print(f"[ERROR] chat log flush ({len(entries)} rows):", e)
+            if len(entries) == 1:
+                self._retry(entries, str(e))
+                return 0
+
+        # 1行の不備でバッチ全体が止まらないよう1行ずつ送り直す
+        sent = 0
+        for entry in entries:
+            try:
+                self._send([entry])
+                self._done([entry])
+                sent += 1
+            except Exception as e:
+                print(f"[ERROR] chat log flush row={entry['row'].get('id')}:", e)
+                self._retry([entry], str(e))
+        return sent
+
+    def start(self):
+        """フラッシャーを起動する（前回の未送信分もここから送り直される）"""
+        with self._lock:
+            alive = self._thread is not None and self._thread.is_alive()
+            if alive and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="chat-log-flusher", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        print(f"[chat log flusher] started pid={os.getpid()} journal={self.path}")
+        while True:
+            try:
+                sent = self.flush()
+            except Exception as e:
+                print("[ERROR] chat log flusher:", e)
+                sent = 0
+
+            if sent < FLUSH_BATCH:
+                self._wakeup.wait(FLUSH_INTERVAL)
+                self._wakeup.clear()
+
+
+chat_log_journal = ChatLogJournal()
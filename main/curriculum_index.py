@@ -0,0 +1,359 @@
+# ============================================
+#  HARUHI：学習指導要領ローカルベクトル索引（FAISS）
+# ============================================
+"""
+curriculum_entries の embedding をプロセス内の FAISS 索引に読み込み、
+match_curriculum_entries RPC と同じ形の行を返すローカル検索バックエンド。
+
+- 全体で数千行なので IndexFlatIP（内積 = 正規化後のコサイン類似度）で十分。
+- (school_stage, subject) ごと・school_stage ごとに索引を分割して持つ。
+- 読み込み完了までは is_ready() が False を返し、呼び出し側は Supabase RPC を使う。
+
+環境変数 CURRICULUM_BACKEND=faiss で有効化（既定は supabase）。
+
+差分更新：
+- 前回同期時の高水位（CURRICULUM_SYNC_COLUMN と id）以降に変化した行だけを取得し、
+  影響する区分の索引だけを作り直す。
+- 新しい索引一式（スナップショット）を組み立ててから参照を差し替えるため、
+  検索側はロックを取らず、マージ中もブロックされない。
+- CURRICULUM_REFRESH_SEC ごとの定期実行と、管理用エンドポイントからの即時実行に対応。
+"""
+
+import os
+import json
+import time
+import threading
+from typing import List, Dict, Any
+
+import numpy as np
+
+try:
+    import faiss
+except ImportError:   # faiss-cpu 未導入環境では RPC のみで動作
+    faiss = None
+
+from supabase_client import supabase
+
+CURRICULUM_BACKEND = os.getenv("CURRICULUM_BACKEND", "supabase")
+CURRICULUM_SYNC_COLUMN = os.getenv("CURRICULUM_SYNC_COLUMN", "updated_at")
+CURRICULUM_REFRESH_SEC = float(os.getenv("CURRICULUM_REFRESH_SEC", "300"))
+
+TABLE_NAME = "curriculum_entries"
+ROW_COLUMNS = (
+    "id, school_stage, subject, chapter, section, subsection, "
+    "category, content, source_page, doc_ref"
+)
+PAGE_SIZE = 1000
+
+
+def _to_vector(value) -> np.ndarray:
+    """pgvector の値（"[0.1, ...]" 文字列 or list）を float32 配列にする"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _normalize(mat: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+class _Partition:
+    """1つの (stage, subject) 区分の索引と行データ"""
+
+    def __init__(self, rows: List[Dict[str, Any]], vectors: np.ndarray):
+        self.rows = rows
+        self.vectors = vectors
+        self.index = faiss.IndexFlatIP(vectors.shape[1])
+        self.index.add(vectors)
+
+    def search(self, qvec: np.ndarray, k: int, threshold: float):
+        k = min(k, len(self.rows))
+        if k <= 0:
+            return []
+        scores, ids = self.index.search(qvec, k)
+        out = []
+        for score, i in zip(scores[0], ids[0]):
+            if i < 0 or score < threshold:
+                continue
+            row = dict(self.rows[i])
+            row["similarity"] = float(score)
+            out.append(row)
+        return out
+
+
+def _partition_keys(row: Dict[str, Any]):
+    stage = row.get("school_stage")
+    subject = row.get("subject")
+    return ((stage, subject), (stage, None), (None, None))
+
+
+class _Snapshot:
+    """
+    検索に使う索引一式。構築後は変更しない（差分更新時は新しく作って差し替える）。
+    """
+
+    def __init__(self, partitions: dict, row_keys: dict, high_water: dict):
+        self.partitions = partitions    # (stage, subject) / (stage, None) / (None, None)
+        self.row_keys = row_keys        # id -> その行が属する区分キー
+        self.high_water = high_water    # {"sync": 最終 sync 列の値, "id": 最大 id}
+
+    @property
+    def row_count(self) -> int:
+        part = self.partitions.get((None, None))
+        return len(part.rows) if part else 0
+
+
+class CurriculumIndex:
+    """
+    学習指導要領のローカル検索索引。
+
+    search() の引数・戻り値は match_curriculum_entries RPC に合わせている：
+        params = {"query_embedding", "match_threshold", "match_count",
+                  "p_school_stage"(任意), "p_subject"(任意)}
+    """
+
+    def __init__(self):
+        self._snapshot = None
+        self._loading = False
+        self._lock = threading.Lock()          # 読み込み・差分更新の直列化（検索では使わない）
+        self._state_lock = threading.Lock()    # 起動状態（_loading / refresher）の保護
+        self._refresher = None
+        self._refresher_pid = None
+        self._sync_column = CURRICULUM_SYNC_COLUMN
+
+    # ================================
+    # 状態
+    # ================================
+    def is_enabled(self) -> bool:
+        return CURRICULUM_BACKEND == "faiss" and faiss is not None
+
+    def is_ready(self) -> bool:
+        return self._snapshot is not None
+
+    # ================================
+    # 読み込み
+    # ================================
+    def _select_columns(self) -> str:
+        cols = f"{ROW_COLUMNS}, embedding"
+        if self._sync_column:
+            cols += f", {self._sync_column}"
+        return cols
+
+    def _fetch_rows(self, since: dict = None) -> List[Dict[str, Any]]:
+        """
+        embedding 済みの行をページ単位で取得する。
+        since を渡すと高水位以降に変化した行のみ。
+        """
+        rows = []
+        start = 0
+        while True:
+            query = (
+                supabase.table(TABLE_NAME)
+                .select(self._select_columns())
+                .not_.is_("embedding", "null")
+            )
+            if since is not None:
+                if self._sync_column and since.get("sync") is not None:
+                    query = query.gte(self._sync_column, since["sync"])
+                else:
+                    query = query.gt("id", since.get("id") or 0)
+
+            resp = query.order("id").range(start, start + PAGE_SIZE - 1).execute()
+            page = resp.data or []
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+        return rows
+
+    def _fetch_rows_with_fallback(self, since: dict = None) -> List[Dict[str, Any]]:
+        try:
+            return self._fetch_rows(since)
+        except Exception as e:
+            if not self._sync_column:
+                raise
+            # 同期列がテーブルに無い場合は id 高水位のみで運用する
+            print(f"[WARN] curriculum index: sync column '{self._sync_column}' unavailable, using id:", e)
+            self._sync_column = None
+            return self._fetch_rows(since)
+
+    def _high_water(self, rows: List[Dict[str, Any]], base: dict = None) -> dict:
+        hw = dict(base or {"sync": None, "id": None})
+        for r in rows:
+            if r.get("id") is not None and (hw["id"] is None or r["id"] > hw["id"]):
+                hw["id"] = r["id"]
+            v = r.get(self._sync_column) if self._sync_column else None
+            if v is not None and (hw["sync"] is None or v > hw["sync"]):
+                hw["sync"] = v
+        return hw
+
+    def _build_snapshot(self, rows: List[Dict[str, Any]]) -> _Snapshot:
+        high_water = self._high_water(rows)
+        vectors = _normalize(np.vstack([_to_vector(r.pop("embedding")) for r in rows]))
+
+        groups = {}
+        row_keys = {}
+        for i, r in enumerate(rows):
+            keys = _partition_keys(r)
+            row_keys[r["id"]] = keys[0]
+            for key in keys:
+                groups.setdefault(key, []).append(i)
+
+        partitions = {}
+        for key, idx in groups.items():
+            partitions[key] = _Partition([rows[i] for i in idx], vectors[idx])
+        return _Snapshot(partitions, row_keys, high_water)
+
+    def load(self):
+        """Supabase から全行を読み込み索引を構築する（数秒）"""
+        with self._lock:
+            rows = self._fetch_rows_with_fallback()
+            if not rows:
+                print("[WARN] curriculum index: no rows with embedding")
+                return
+            snapshot = self._build_snapshot(rows)
+            self._snapshot = snapshot
+        print(
+            f"[INFO] curriculum index loaded: {snapshot.row_count} rows, "
+            f"{len(snapshot.partitions)} partitions"
+        )
+
+    def load_async(self):
+        """バックグラウンドで load() し、定期差分更新を開始する（二重起動しない）"""
+        if not self.is_enabled():
+            return
+        self.start_refresher()
+        with self._state_lock:
+            if self._snapshot is not None or self._loading:
+                return
+            self._loading = True
+
+        def _run():
+            try:
+                self.load()
+            except Exception as e:
+                print("[ERROR] curriculum index load:", e)
+            finally:
+                self._loading = False
+
+        threading.Thread(target=_run, name="curriculum-index-load", daemon=True).start()
+
+    # ================================
+    # 差分更新
+    # ================================
+    def refresh(self) -> dict:
+        """
+        高水位以降に追加・更新された行だけを取り込む。
+        戻り値：{"changed": 取り込んだ行数, "rows": 索引全体の行数}
+        """
+        if not self.is_enabled():
+            return {"changed": 0, "rows": 0, "enabled": False}
+
+        with self._lock:
+            current = self._snapshot
+            if current is None:
+                rows = self._fetch_rows_with_fallback()
+                if rows:
+                    self._snapshot = self._build_snapshot(rows)
+                return {"changed": len(rows), "rows": len(rows)}
+
+            since = current.high_water
+            changed = self._fetch_rows_with_fallback(since=since)
+            # gte で取得するため高水位ちょうどの既知行が再度含まれる → 除外
+            if self._sync_column and since.get("sync") is not None:
+                changed = [
+                    r for r in changed
+                    if not (r.get(self._sync_column) == since["sync"] and r["id"] in current.row_keys)
+                ]
+            if not changed:
+                return {"changed": 0, "rows": current.row_count}
+
+            self._snapshot = self._merge(current, changed)
+            print(f"[INFO] curriculum index refreshed: {len(changed)} rows merged")
+            return {"changed": len(changed), "rows": self._snapshot.row_count}
+
+    def _merge(self, current: _Snapshot, changed: List[Dict[str, Any]]) -> _Snapshot:
+        """
+        変化した行を反映した新しいスナップショットを作る。
+        影響を受けた区分だけ索引を作り直し、それ以外は現行の区分をそのまま共有する。
+        """
+        high_water = self._high_water(changed, base=current.high_water)
+        changed_ids = {r["id"] for r in changed}
+        new_vectors = _normalize(np.vstack([_to_vector(r.pop("embedding")) for r in changed]))
+
+        # 影響区分：旧所属（区分移動した行の除去）＋新所属
+        affected = set()
+        row_keys = dict(current.row_keys)
+        for r in changed:
+            old_key = current.row_keys.get(r["id"])
+            if old_key is not None:
+                affected.update(_partition_keys({"school_stage": old_key[0], "subject": old_key[1]}))
+            keys = _partition_keys(r)
+            affected.update(keys)
+            row_keys[r["id"]] = keys[0]
+
+        partitions = dict(current.partitions)
+        for key in affected:
+            rows = []
+            vecs = []
+            old = current.partitions.get(key)
+            if old is not None:
+                for row, vec in zip(old.rows, old.vectors):
+                    if row["id"] not in changed_ids:
+                        rows.append(row)
+                        vecs.append(vec)
+            for row, vec in zip(changed, new_vectors):
+                if key in _partition_keys(row):
+                    rows.append(row)
+                    vecs.append(vec)
+
+            if rows:
+                partitions[key] = _Partition(rows, np.vstack(vecs))
+            else:
+                partitions.pop(key, None)
+
+        return _Snapshot(partitions, row_keys, high_water)
+
+    def start_refresher(self):
+        """CURRICULUM_REFRESH_SEC ごとに refresh() する常駐スレッドを開始する"""
+        if not self.is_enabled() or CURRICULUM_REFRESH_SEC <= 0:
+            return
+        with self._state_lock:
+            alive = self._refresher is not None and self._refresher.is_alive()
+            if alive and self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+
+            def _run():
+                while True:
+                    time.sleep(CURRICULUM_REFRESH_SEC)
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        print("[ERROR] curriculum index refresh:", e)
+
+            self._refresher = threading.Thread(
+                target=_run, name="curriculum-index-refresh", daemon=True
+            )
+            self._refresher.start()
+
+    # ================================
+    # 検索
+    # ================================
+    def search(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        snapshot = self._snapshot        # 参照を1回だけ読む（差し替えと競合しない）
+        if snapshot is None:
+            return []
+
+        key = (params.get("p_school_stage"), params.get("p_subject"))
+        partition = snapshot.partitions.get(key)
+        if partition is None:
+            return []
+
+        qvec = _normalize(_to_vector(params["query_embedding"]).reshape(1, -1))
+        return partition.search(qvec, params["match_count"], params["match_threshold"])
+
+
+curriculum_index = CurriculumIndex()
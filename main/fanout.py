@@ -0,0 +1,129 @@
+# ============================================
+#  HARUHI：並列実行レイヤー
+# ============================================
+"""
+/haruhi_chat 内の互いに独立した処理（履歴取得・PDG親取得・タイトル生成・RAG検索）を
+共有スレッドプールで同時に走らせるためのヘルパー。
+
+- 各ステップにタイムアウトを設定でき、超過したステップは既定値で置き換える。
+  タイムアウトはステップが実際に開始した時点から数える（プールの空き待ちは含めない）。
+  空き待ちは FANOUT_QUEUE_TIMEOUT 秒までとし、超えたら開始前に取り消す。
+- 開始済みのスレッドは止められないため、タイムアウト後は結果を捨てるだけになる
+  （外部 API 呼び出し側のタイムアウトと併用すること）。
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+FANOUT_WORKERS = int(os.getenv("HARUHI_FANOUT_WORKERS", "16"))
+FANOUT_QUEUE_TIMEOUT = float(os.getenv("HARUHI_FANOUT_QUEUE_TIMEOUT", "30"))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    プロセス共有のスレッドプール。
+    gunicorn の fork 後は子プロセス側で作り直す。
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=FANOUT_WORKERS,
+                thread_name_prefix="haruhi-fanout",
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+class Step:
+    """並列実行する1ステップ"""
+
+    def __init__(self, fn, *args, timeout: float = 10.0, default=None, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.default = default
+        self.started = threading.Event()
+        self.started_at = None
+
+    def run(self):
+        """プールのスレッドで実行される本体（開始時刻を記録してから fn を呼ぶ）"""
+        self.started_at = time.monotonic()
+        self.started.set()
+        return self.fn(*self.args, **self.kwargs)
+
+
+class FanOut:
+    """
+    使い方：
+        fan = FanOut({
+            "context":  Step(load_recent_context, session_id, timeout=5, default=[]),
+            "retrieve": Step(engine.retrieve, query, timeout=15),
+        })
+        context = fan.result("context")
+        meta = fan.result("retrieve")
+    """
+
+    def __init__(self, steps: dict):
+        self.steps = steps
+        self.submitted_at = time.monotonic()
+        executor = get_executor()
+        self.futures = {
+            name: executor.submit(step.run)
+            for name, step in steps.items()
+        }
+
+    def result(self, name: str):
+        """
+        ステップの結果を待って返す。
+        タイムアウト・例外時は Step.default を返す。
+        """
+        step = self.steps[name]
+        future = self.futures[name]
+
+        # プールの空き待ち（ステップのタイムアウトには含めない）
+        queued_for = FANOUT_QUEUE_TIMEOUT - (time.monotonic() - self.submitted_at)
+        if not step.started.wait(max(queued_for, 0)):
+            if future.cancel():
+                print(f"[WARN] fanout step {name} not started within "
+                      f"{FANOUT_QUEUE_TIMEOUT}s (pool busy), cancelled")
+                return step.default
+
+        # cancel() に失敗した直後は started_at の記録前のことがある
+        started_at = step.started_at or time.monotonic()
+        remaining = step.timeout - (time.monotonic() - started_at)
+        try:
+            return future.result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            # 実行中の future は cancel() できない（False が返る）ので結果を捨てるだけ
+            if future.cancel():
+                print(f"[WARN] fanout step timeout: {name} ({step.timeout}s), cancelled")
+            else:
+                print(f"[WARN] fanout step timeout: {name} ({step.timeout}s), "
+                      f"still running in background, result discarded")
+            return step.default
+        except Exception as e:
+            print(f"[ERROR] fanout step {name}:", e)
+            return step.default
+
+    def cancel_pending(self) -> int:
+        """
+        まだ開始していないステップを取り消す（リクエストの失敗・切断時に呼ぶ）。
+        開始済みのステップは止められないため、終わるまでプールのスレッドを使い続ける。
+        戻り値は取り消せたステップ数。
+        """
+        cancelled = [name for name, future in self.futures.items() if future.cancel()]
+        running = [
+            name for name, future in self.futures.items()
+            if not future.done() and name not in cancelled
+        ]
+        if cancelled or running:
+            print(f"[WARN] fanout cancel: cancelled={cancelled} still running={running}")
+        return len(cancelled)
@@ -0,0 +1,223 @@
+# ============================================
+#  さくら：FAQ ローカル索引（NumPy）
+# ============================================
+"""
+haruhi_faqs（数十行）を丸ごとプロセス内に読み込み、
+match_faqs RPC と同じ形の行を返すローカル検索バックエンド。
+
+- embedding は正規化済み行列で持ち、top-k は1回の行列×ベクトル積で求める。
+- 質問文の完全一致・正規化一致は lookup_exact() で引ける（GPT 不要）。
+- 変更検知：FAQ_REFRESH_SEC ごとに (id, question, answer) の署名だけを取得し、
+  変わっていれば全体を読み直す。
+- invalidate() は共有の世代番号（local_store.shared_versions）を進める。
+  どのワーカーも読み込み時の世代と比べて古ければ読み直すので、
+  他ワーカーや読み込み中の無効化も取りこぼさない。
+- 読み込み完了まで（無効化後の読み直し中を含む）は is_ready() が False を返し、
+  呼び出し側は RPC を使う。
+
+環境変数 SAKURA_FAQ_INDEX=0 で無効化（常に RPC）。
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+from supabase_client import supabase
+from embedding_service import embed_texts
+from local_store import shared_versions
+from text_normalize import normalize_question
+
+FAQ_INDEX_ENABLED = os.getenv("SAKURA_FAQ_INDEX", "1") != "0"
+FAQ_REFRESH_SEC = float(os.getenv("FAQ_REFRESH_SEC", "300"))
+
+TABLE_NAME = "haruhi_faqs"
+VERSION_KEY = "haruhi_faqs"     # shared_versions の名前（/get_faqs のキャッシュと共通）
+ROW_COLUMNS = "id, question, answer, importance"
+
+
+def _to_vector(value) -> np.ndarray:
+    """pgvector の値（"[0.1, ...]" 文字列 or list）を float32 配列にする"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _signature(rows: List[Dict[str, Any]]) -> str:
+    digest = hashlib.sha256()
+    for r in sorted(rows, key=lambda r: str(r.get("id"))):
+        digest.update(json.dumps(
+            [r.get("id"), r.get("question"), r.get("answer")], ensure_ascii=False
+        ).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class _Snapshot:
+    """読み込み済みの FAQ 一式（作成後は変更しない）"""
+
+    def __init__(self, rows: List[Dict[str, Any]], vectors: np.ndarray, signature: str,
+                 generation: int):
+        self.rows = rows
+        self.vectors = vectors
+        self.signature = signature
+        self.generation = generation    # 読み込み開始時点の共有世代番号
+        self.exact = {}
+        for row in rows:
+            key = normalize_question(row.get("question"))
+            if key and key not in self.exact:
+                self.exact[key] = row
+
+
+class FaqIndex:
+
+    def __init__(self):
+        self._snapshot: Optional[_Snapshot] = None
+        self._lock = threading.Lock()         # 読み込みの直列化
+        self._state_lock = threading.Lock()   # _loading / _checked_at の更新
+        self._loading = False
+        self._checked_at = 0.0
+
+    def is_enabled(self) -> bool:
+        return FAQ_INDEX_ENABLED
+
+    def _current(self) -> Optional[_Snapshot]:
+        """
+        最新世代のスナップショット。無効化されていれば読み直しを始めて None
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        if shared_versions.get(VERSION_KEY) != snapshot.generation:
+            self.load_async()
+            return None
+        return snapshot
+
+    def is_ready(self) -> bool:
+        return self._current() is not None
+
+    # ================================
+    # 読み込み
+    # ================================
+    def load(self):
+        """全行と embedding を読み込み行列を作る"""
+        with self._lock:
+            # 先に世代を読む（読み込み中に無効化されたら次回の比較で読み直す）
+            generation = shared_versions.get(VERSION_KEY)
+            rows = (
+                supabase.table(TABLE_NAME)
+                .select(f"{ROW_COLUMNS}, embedding")
+                .execute()
+            ).data or []
+            signature = _signature(rows)
+
+            # embedding 未登録の行は共通埋め込みサービスで補う
+            missing = [r for r in rows if not r.get("embedding") and r.get("question")]
+            if missing:
+                for r, vec in zip(missing, embed_texts([r["question"] for r in missing])):
+                    r["embedding"] = vec
+
+            rows = [r for r in rows if r.get("embedding")]
+            vectors = (
+                np.vstack([_to_vector(r.pop("embedding")) for r in rows])
+                if rows else np.zeros((0, 0), dtype=np.float32)
+            )
+            if rows:
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                vectors = vectors / norms
+
+            self._snapshot = _Snapshot(rows, vectors, signature, generation)
+            self._checked_at = time.monotonic()
+        print(f"[INFO] FAQ index loaded: {len(rows)} rows")
+
+    def load_async(self):
+        """バックグラウンドで load() する（二重起動しない）"""
+        if not self.is_enabled():
+            return
+        with self._state_lock:
+            if self._loading:
+                return
+            self._loading = True
+
+        def _run():
+            try:
+                self.load()
+            except Exception as e:
+                print("[ERROR] FAQ index load:", e)
+            finally:
+                self._loading = False
+
+        threading.Thread(target=_run, name="faq-index-load", daemon=True).start()
+
+    def invalidate(self):
+        """FAQ を更新したときに呼ぶ。全ワーカーが次回アクセス時に読み直す"""
+        shared_versions.bump(VERSION_KEY)
+        self.load_async()
+
+    def _check_for_changes(self):
+        rows = supabase.table(TABLE_NAME).select("id, question, answer").execute().data or []
+        snapshot = self._snapshot
+        if snapshot is None or _signature(rows) != snapshot.signature:
+            self.load()
+
+    def _maybe_refresh(self):
+        """FAQ_REFRESH_SEC ごとに署名を確認し、変わっていれば読み直す（非同期）"""
+        if FAQ_REFRESH_SEC <= 0:
+            return
+        with self._state_lock:
+            if self._loading or time.monotonic() - self._checked_at < FAQ_REFRESH_SEC:
+                return
+            self._loading = True
+            self._checked_at = time.monotonic()
+
+        def _run():
+            try:
+                self._check_for_changes()
+            except Exception as e:
+                print("[ERROR] FAQ index refresh:", e)
+            finally:
+                self._loading = False
+
+        threading.Thread(target=_run, name="faq-index-refresh", daemon=True).start()
+
+    # ================================
+    # 検索
+    # ================================
+    def lookup_exact(self, query: str) -> Optional[Dict[str, Any]]:
+        """質問文が FAQ と一致（正規化後）すればその行を返す"""
+        snapshot = self._current()
+        if snapshot is None:
+            return None
+        self._maybe_refresh()
+        return snapshot.exact.get(normalize_question(query))
+
+    def search(self, query_vec: List[float], k: int) -> List[Dict[str, Any]]:
+        """match_faqs RPC と同じ形（行 + score）で上位 k 件を返す"""
+        snapshot = self._current()
+        if snapshot is None or not snapshot.rows or k <= 0:
+            return []
+        self._maybe_refresh()
+
+        qvec = np.asarray(query_vec, dtype=np.float32)
+        norm = float(np.linalg.norm(qvec))
+        if norm == 0.0:
+            return []
+        scores = snapshot.vectors @ (qvec / norm)
+
+        k = min(k, len(snapshot.rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        out = []
+        for i in top:
+            row = dict(snapshot.rows[i])
+            row["score"] = float(scores[i])
+            out.append(row)
+        return out
+
+
+faq_index = FaqIndex()
@@ -1,14 +1,15 @@
-import os
-from typing import List, Dict, Any
-import openai
+import json
+from typing import List, Dict, Any, Iterator, Tuple
 from supabase_client import supabase
+from request_context import shared_embedding
+from embedding_service import embed_text
+from main.curriculum_index import curriculum_index
+from main.answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+from openai_client import get_openai, CHAT_TIMEOUT
 
 # ===============================
 # OpenAI 設定
 # ===============================
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
-
 EMBED_MODEL = "text-embedding-3-small"   # JEISI標準
 CHAT_MODEL  = "gpt-4o"                   # 教育対話向け
 
@@ -20,6 +21,92 @@ def _safe_float(x, default=0.0) -> float:
         return default
 
 
+# ================================
+# エビデンスの保存形式（id + 類似度のみ）
+# ================================
+EVIDENCE_VERSION = 2
+CURRICULUM_COLUMNS = (
+    "id, school_stage, subject, chapter, section, subsection, "
+    "category, content, source_page, doc_ref"
+)
+
+
+def curriculum_refs(rows) -> List[Dict[str, Any]]:
+    """curriculum 行を保存用の {id, similarity} にする"""
+    return [
+        {"id": r.get("id"), "similarity": r.get("similarity")}
+        for r in rows or [] if r.get("id") is not None
+    ]
+
+
+def compact_evidence(evidence: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    保存用に curriculum を id と類似度だけにする。
+    本文・出典は expand_evidence_many() で読み出し時に復元する。
+    （指導案RAGは停止中のため lesson_plans はそのまま）
+    """
+    if not evidence:
+        return evidence
+    return {
+        "v": EVIDENCE_VERSION,
+        "curriculum": curriculum_refs(evidence.get("curriculum")),
+        "lesson_plans": evidence.get("lesson_plans") or [],
+    }
+
+
+def _is_refs(items) -> bool:
+    return isinstance(items, list) and all(
+        isinstance(r, dict) and set(r) <= {"id", "similarity"} for r in items
+    )
+
+
+def expand_evidence_many(stored_list: list) -> list:
+    """
+    保存されたエビデンス（複数行分）を curriculum 行の形に戻す。
+    参照される curriculum_entries は1回の問い合わせでまとめて取得する。
+    従来形式（行そのものを保存）はそのまま返す。
+        PDG 保存分       … [{id, similarity}, ...]
+        アシスタント応答 … {"v": 2, "curriculum": [...], "lesson_plans": [...]}
+    """
+    ids = set()
+    for stored in stored_list:
+        if _is_refs(stored):
+            ids.update(r["id"] for r in stored)
+        elif isinstance(stored, dict) and stored.get("v") == EVIDENCE_VERSION:
+            ids.update(r["id"] for r in stored.get("curriculum") or [])
+
+    by_id = {}
+    if ids:
+        rows = (
+            supabase.table("curriculum_entries")
+            .select(CURRICULUM_COLUMNS)
+            .in_("id", list(ids))
+            .execute()
+        ).data or []
+        by_id = {r["id"]: r for r in rows}
+
+    def _expand(refs):
+        out = []
+        for ref in refs or []:
+            row = by_id.get(ref["id"])
+            if row is not None:
+                out.append(dict(row, similarity=ref.get("similarity"), citation=_build_citation(row)))
+        return out
+
+    out = []
+    for stored in stored_list:
+        if stored and _is_refs(stored):
+            out.append(_expand(stored))
+        elif isinstance(stored, dict) and stored.get("v") == EVIDENCE_VERSION:
+            out.append({
+                "curriculum": _expand(stored.get("curriculum")),
+                "lesson_plans": stored.get("lesson_plans") or [],
+            })
+        else:
+            out.append(stored)
+    return out
+
+
 # ================================
 # 教科推定用キーワード
 # ================================
@@ -90,6 +177,19 @@ SUBJECT_LABEL = {
 }
 
 
+# 教科が推定できないときの問い返しメッセージ
+ASK_SUBJECT_MESSAGE = (
+    "今の問いは、とても大切な観点を含んでいます。\n\n"
+    "ただ、どの教科の立場から考えるかによって、"
+    "『見方・考え方』や重視点が変わります。\n\n"
+    "どの教科について考えたいか、教えてもらえますか？\n"
+    "（例：小学校理科／社会／算数／外国語／道徳 など）"
+)
+
+# 応答生成に失敗したときのメッセージ（回答キャッシュには保存しない）
+GENERATE_ERROR_MESSAGE = "応答生成中にエラーが発生しました。"
+
+
 def _build_citation(row: Dict[str, Any]) -> str:
     """
     school_stage・subject・source_page から出典文字列を生成する。
@@ -137,7 +237,10 @@ class RagEngineHARUHI:
     ★ 互換ポイント（routes.py との整合を維持）
         - __init__(top_k=5, threshold=0.70)
         - answer(user_query) → (reply, meta)
+        - answer_stream(user_query) → (event, data) のジェネレータ
         - meta に reply_mode ("RAG" | "LLM" | "ASK") を追加
+        - ctx（RequestContext）を渡すとクエリ embedding をリクエスト内で共有
+        - 会話履歴なしの問いは意味的回答キャッシュ（answer_cache）で再利用
     """
 
     def __init__(self, top_k: int = 5, threshold: float = 0.70):
@@ -180,6 +283,22 @@ class RagEngineHARUHI:
         else:
             return 0.60
 
+    # ================================
+    # 指導要領ベクトル検索（ローカル索引 → RPC フォールバック）
+    # ================================
+    def _match_curriculum(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if curriculum_index.is_enabled():
+            if curriculum_index.is_ready():
+                try:
+                    return curriculum_index.search(params)
+                except Exception as e:
+                    print("[ERROR] local curriculum search:", e)
+            else:
+                curriculum_index.load_async()
+
+        resp = supabase.rpc("match_curriculum_entries", params).execute()
+        return resp.data or []
+
     # ================================
     # 指導要領検索（RPC利用）
     # ================================
@@ -190,15 +309,16 @@ class RagEngineHARUHI:
         threshold: float = None,
         school_stage: str = None,
         subject: str = None,
+        ctx=None,
     ) -> List[Dict[str, Any]]:
         try:
             if threshold is None:
                 threshold = self.base_threshold
 
-            qvec = client.embeddings.create(
-                model=EMBED_MODEL,
-                input=query
-            ).data[0].embedding
+            # 同一リクエスト内で生成済みの embedding があれば再利用
+            qvec = shared_embedding(ctx, query)
+            if qvec is None:
+                qvec = embed_text(query, model=EMBED_MODEL)
 
             subject_norm = subject.upper() if isinstance(subject, str) else None
 
@@ -214,8 +334,7 @@ class RagEngineHARUHI:
 
             print("[DEBUG] curriculum search params:", params)
 
-            resp = supabase.rpc("match_curriculum_entries", params).execute()
-            rows = resp.data or []
+            rows = self._match_curriculum(params)
 
             if not rows and subject_norm:
                 print("[DEBUG] retry curriculum search without subject")
@@ -227,10 +346,7 @@ class RagEngineHARUHI:
                 if school_stage:
                     params_fallback["p_school_stage"] = school_stage
 
-                resp = supabase.rpc(
-                    "match_curriculum_entries", params_fallback
-                ).execute()
-                rows = resp.data or []
+                rows = self._match_curriculum(params_fallback)
 
             out = []
             for r in rows:
@@ -259,10 +375,7 @@ class RagEngineHARUHI:
     # ================================
     def search_lesson_plans(self, query: str, k: int = 5) -> List[Dict[str, Any]]:
         try:
-            qvec = client.embeddings.create(
-                model=EMBED_MODEL,
-                input=query
-            ).data[0].embedding
+            qvec = embed_text(query, model=EMBED_MODEL)
 
             resp = supabase.rpc(
                 "match_lesson_plans",
@@ -398,21 +511,46 @@ class RagEngineHARUHI:
     # ================================
     def _generate(self, messages) -> str:
         try:
-            resp = client.chat.completions.create(
+            resp = get_openai().chat.completions.create(
                 model=CHAT_MODEL,
                 messages=messages,
+                timeout=CHAT_TIMEOUT,
             )
             return resp.choices[0].message.content.strip()
         except Exception as e:
             print("[ERROR] HARUHI generate:", e)
-            return "応答生成中にエラーが発生しました。"
+            return GENERATE_ERROR_MESSAGE
 
     # ================================
-    # 統合処理：HARUHI回答
+    # GPT 応答生成（ストリーミング）
     # ================================
-    def answer(self, user_query: str, context_messages: List[Dict[str, str]] = None):
-        print("=== ANSWER() ENTER ===")
+    def _generate_stream(self, messages) -> Iterator[str]:
+        """トークン（差分テキスト）を届いた順に yield する"""
+        try:
+            stream = get_openai().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                timeout=CHAT_TIMEOUT,
+                stream=True,
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except Exception as e:
+            print("[ERROR] HARUHI generate_stream:", e)
+            yield GENERATE_ERROR_MESSAGE
 
+    # ================================
+    # 検索処理：校種・教科推定 + 指導要領RAG
+    # ================================
+    def retrieve(self, user_query: str, ctx=None) -> Dict[str, Any]:
+        """
+        回答生成の前段（推定・検索）だけを行い meta を返す。
+        教科が推定できない場合は reply_mode = "ASK"。
+        """
         # ① 校種・教科推定
         result = self._infer_stage_subject(user_query)
         if result is None:
@@ -424,14 +562,7 @@ class RagEngineHARUHI:
         # ② 教科が取れない場合：問い返し
         if subject is None:
             print("RETURN: subject_none")
-            msg = (
-                "今の問いは、とても大切な観点を含んでいます。\n\n"
-                "ただ、どの教科の立場から考えるかによって、"
-                "『見方・考え方』や重視点が変わります。\n\n"
-                "どの教科について考えたいか、教えてもらえますか？\n"
-                "（例：小学校理科／社会／算数／外国語／道徳 など）"
-            )
-            return msg, {
+            return {
                 "curriculum":   [],
                 "lesson_plans": [],
                 "subject":      None,
@@ -458,6 +589,7 @@ class RagEngineHARUHI:
             threshold=dyn_th,
             school_stage=stage,
             subject=subject,
+            ctx=ctx,
         )
         print("[DEBUG] Curriculum RAG results:", curriculum)
 
@@ -467,8 +599,81 @@ class RagEngineHARUHI:
         reply_mode = "RAG" if (curriculum or lessons) else "LLM"
         print(f"[DEBUG] reply_mode: {reply_mode}")
 
+        return {
+            "curriculum":   curriculum,
+            "lesson_plans": lessons,
+            "subject":      subject,
+            "stage":        stage,
+            "reply_mode":   reply_mode,
+        }
+
+    def fallback_meta(self, user_query: str) -> Dict[str, Any]:
+        """
+        検索がタイムアウトした場合の meta（根拠なし → LLM 回答）。
+        校種・教科推定はローカル処理なのでここでも行う。
+        """
+        stage, subject = self._infer_stage_subject(user_query)
+        return {
+            "curriculum":   [],
+            "lesson_plans": [],
+            "subject":      subject,
+            "stage":        stage,
+            "reply_mode":   "ASK" if subject is None else "LLM",
+        }
+
+    # ================================
+    # 意味的回答キャッシュ
+    # ================================
+    def _answer_cache_vector(self, user_query: str, context_messages, ctx=None):
+        """
+        回答キャッシュを使える場合はクエリ embedding を返す（使えない場合は None）。
+        ユーザー発話（直近の問い・PDG系譜）を含む履歴があると同じ問いでも
+        回答が変わるため使わない。アシスタント行だけ（セッション冒頭の挨拶）は対象にする。
+        """
+        if not ANSWER_CACHE_ENABLED:
+            return None
+        if any(m.get("role") == "user" for m in context_messages or []):
+            return None
+        try:
+            return shared_embedding(ctx, user_query) or embed_text(user_query)
+        except Exception as e:
+            print("[ERROR] answer cache embedding:", e)
+            return None
+
+    def _store_answer(self, query_vec, meta: Dict[str, Any], reply: str):
+        if query_vec is None or not reply or reply.endswith(GENERATE_ERROR_MESSAGE):
+            return
+        answer_cache.set(query_vec, meta, reply)
+
+    # ================================
+    # 統合処理：HARUHI回答
+    # ================================
+    def answer(
+        self,
+        user_query: str,
+        context_messages: List[Dict[str, str]] = None,
+        ctx=None,
+        retrieved: Dict[str, Any] = None,
+    ):
+        print("=== ANSWER() ENTER ===")
+
+        # retrieve() を先行実行済みならその結果を使う
+        meta = retrieved if retrieved is not None else self.retrieve(user_query, ctx=ctx)
+        if meta["reply_mode"] == "ASK":
+            return ASK_SUBJECT_MESSAGE, meta
+
+        # 同じ根拠・ほぼ同じ問いの回答があれば再利用
+        query_vec = self._answer_cache_vector(user_query, context_messages, ctx=ctx)
+        if query_vec is not None:
+            cached = answer_cache.get(query_vec, meta)
+            if cached is not None:
+                print("RETURN: answer cache hit")
+                return cached, meta
+
         # ⑥ プロンプト構築（PDG+直近履歴を渡す）
-        messages = self._build_prompt(user_query, curriculum, lessons, context_messages)
+        messages = self._build_prompt(
+            user_query, meta["curriculum"], meta["lesson_plans"], context_messages
+        )
         if messages is None:
             raise RuntimeError("_build_prompt returned None")
 
@@ -477,15 +682,59 @@ class RagEngineHARUHI:
         if reply is None:
             raise RuntimeError("_generate returned None")
 
+        self._store_answer(query_vec, meta, reply)
         print("RETURN: normal")
 
-        return reply, {
-            "curriculum":   curriculum,
-            "lesson_plans": lessons,
-            "subject":      subject,
-            "stage":        stage,
-            "reply_mode":   reply_mode,
-        }
+        return reply, meta
+
+    # ================================
+    # 統合処理：HARUHI回答（ストリーミング）
+    # ================================
+    def answer_stream(
+        self,
+        user_query: str,
+        context_messages: List[Dict[str, str]] = None,
+        ctx=None,
+        retrieved: Dict[str, Any] = None,
+    ) -> Iterator[Tuple[str, Any]]:
+        """
+        answer() のジェネレータ版。(event, data) を順に yield する。
+            ("meta",  meta)    … 検索結果（根拠・出典）。最初に1回
+            ("token", str)     … 応答テキストの差分
+            ("done",  reply)   … 完成した応答全文。最後に1回
+        """
+        print("=== ANSWER_STREAM() ENTER ===")
+
+        meta = retrieved if retrieved is not None else self.retrieve(user_query, ctx=ctx)
+        yield "meta", meta
+
+        if meta["reply_mode"] == "ASK":
+            yield "token", ASK_SUBJECT_MESSAGE
+            yield "done", ASK_SUBJECT_MESSAGE
+            return
+
+        query_vec = self._answer_cache_vector(user_query, context_messages, ctx=ctx)
+        if query_vec is not None:
+            cached = answer_cache.get(query_vec, meta)
+            if cached is not None:
+                print("RETURN: answer cache hit (stream)")
+                yield "token", cached
+                yield "done", cached
+                return
+
+        messages = self._build_prompt(
+            user_query, meta["curriculum"], meta["lesson_plans"], context_messages
+        )
+
+        parts = []
+        for delta in self._generate_stream(messages):
+            parts.append(delta)
+            yield "token", delta
+
+        reply = "".join(parts).strip()
+        self._store_answer(query_vec, meta, reply)
+        yield "done", reply
+
     # ================================
     # 思考ナビゲーター生成
     # ================================
@@ -529,12 +778,74 @@ class RagEngineHARUHI:
                 {"role": "user", "content": user},
             ]
 
-            resp = client.chat.completions.create(
+            resp = get_openai().chat.completions.create(
                 model=CHAT_MODEL,
                 messages=messages,
+                timeout=CHAT_TIMEOUT,
             )
             return resp.choices[0].message.content.strip()
 
         except Exception as e:
             print("[ERROR] generate_navigator_advice:", e)
-            return "思考ナビゲーターの生成中にエラーが発生しました。"
\ No newline at end of file
+            return "思考ナビゲーターの生成中にエラーが発生しました。"
+
+    def generate_navigator_update(
+        self,
+        previous_summary: str,
+        new_nodes: list,
+    ) -> Tuple[str, str]:
+        """
+        思考ナビゲーターの差分生成。
+        前回までの要約（previous_summary）と新しい問い（new_nodes）だけを渡し、
+        (助言, 更新後の要約) を返す。失敗時は (エラーメッセージ, None)。
+        """
+        try:
+            questions_text = "\n".join(
+                [f"- {n.get('text', '')}" for n in new_nodes if n.get("text")]
+            )
+
+            system = (
+                "あなたはJEISIの教育思考支援AI『HARUHI』です。\n"
+                "教師の思考の伴走者として、問いの系譜（PDG）を分析し、\n"
+                "思考の現在地と次の一手を示してください。\n\n"
+                "次の2つのキーを持つ JSON だけを出力してください。\n"
+                "\"summary\": これまでの問いの流れ全体の要約（400字以内。次回の入力に使う）\n"
+                "\"advice\": 以下の3項目を含む助言（Markdown）\n"
+                "🧭 **思考の現在地**\n"
+                "（これまでの問いの流れを2〜3文で要約する）\n\n"
+                "🔍 **まだ探っていない領域**\n"
+                "（問いの偏りや未検討の観点を具体的に指摘する）\n\n"
+                "➡ **次の問いへの提案**\n"
+                "（次に投げかけると思考が深まる問いを1〜2個示す）\n"
+            )
+
+            user = (
+                f"これまでの問いの要約：\n{previous_summary or '（なし：最初の分析）'}\n\n"
+                f"新しく追加された問い：\n{questions_text}\n\n"
+                "要約を更新し、思考ナビゲーターとしての助言を生成してください。"
+            )
+
+            resp = get_openai().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": user},
+                ],
+                response_format={"type": "json_object"},
+                timeout=CHAT_TIMEOUT,
+            )
+            data = json.loads(resp.choices[0].message.content)
+            advice = (data.get("advice") or "").strip()
+            summary = (data.get("summary") or "").strip()
+            if not advice or not summary:
+                raise ValueError("navigator response missing advice/summary")
+            return advice, summary
+
+        except Exception as e:
+            print("[ERROR] generate_navigator_update:", e)
+            return "思考ナビゲーターの生成中にエラーが発生しました。", None
+
+# ================================
+# 共有インスタンス（routes / PDG保存で共通利用）
+# ================================
+haruhi_engine = RagEngineHARUHI(top_k=5, threshold=0.70)
@@ -4,7 +4,7 @@
 
 import os
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 from supabase_client import supabase
@@ -12,58 +12,62 @@ from supabase_client import supabase
 from pdg_question_detector_v2 import is_question
 from pdg_question_vectorizer_v2 import generate_question_vector
 from pdg_lineage_v2 import determine_parent_id
+from pdg_question_index import question_index
+from pdg_vector_codec import vector_fields, packed_column, stored_vector
 
-# 重要：HARUHI専用RAGエンジン
-from main.haruhi_rag_engine import RagEngineHARUHI
-rag_engine = RagEngineHARUHI()
+# 重要：HARUHI専用RAGエンジン（routes と同じインスタンスを共有）
+from main.haruhi_rag_engine import haruhi_engine as rag_engine, curriculum_refs, compact_evidence
+from main.pdg_worker import pdg_worker, JobDeferred
+from main.chat_log_journal import chat_log_journal
+from main.pdg_graph import pdg_graph
+from request_context import RequestContext
 
 load_dotenv()
 
+# PDG 処理をバックグラウンドで行うか（"0" で従来どおり同期処理）
+PDG_BACKGROUND = os.getenv("PDG_BACKGROUND", "1") != "0"
 
-def save_chat_message_with_pdg(user_id: str, session_id: str, message: str, role: str):
-    record_id = str(uuid.uuid4())
+PDG_JOB_KIND = "pdg_user_message"
 
-    # ============================================
-    # assistant（HARUHI応答）はPDG処理なし
-    # ============================================
-    if role == "assistant":
+# PDG 項目を書き戻した時刻を記録する列（/get_pdg_tree の since= で使用）
+# 空文字で無効化。列がない DB では初回失敗時に自動で無効化する
+PDG_SYNC_COLUMN = os.getenv("PDG_SYNC_COLUMN", "updated_at")
+_sync_column_enabled = bool(PDG_SYNC_COLUMN)
 
-        supabase.table("haruhi_chat_logs").insert({
-            "id": record_id,
-            "user_id": user_id,
-            "session_id": session_id,
-            "role": role,
-            "message": None,
-            "response": message,
-            "is_question": False,
-            "question_vector": None,
-            "parent_id": None,
-            "evidence": None,
-            "timestamp": datetime.utcnow().isoformat()
-        }).execute()
-
-        print(f"[PDG保存完了] {record_id}")
-        return {
-            "record_id": record_id,
-            "session_id": session_id,
-            "parent_id": None
-        }
-
-    # ============================================
-    # user（質問）はPDG処理
-    # ============================================
 
+def compute_pdg_fields(
+    message: str, ctx=None, user_id: str = None, session_id: str = None, record_id: str = None
+) -> dict:
+    """
+    ユーザー発話1件分の PDG 項目を計算する。
+    （問い判定 → ベクトル生成 → 親問い推定 → エビデンス検索）
+    record_id（保存する行の id）とその子孫は親候補から外す。
+    """
     # 問い判定
     question_flag = is_question(message)
 
     # ベクトル生成
-    vector = generate_question_vector(message) if question_flag else None
+    vector = None
+    if question_flag:
+        vector = generate_question_vector(message, ctx=ctx)
 
     # 親問い推定（系譜）
     parent_id = None
     if question_flag:
         try:
-            pdg_result = determine_parent_id(message)
+            exclude = {record_id} if record_id else set()
+            if record_id and user_id:
+                exclude |= pdg_graph.descendants(user_id, record_id)
+            # 問い判定・ベクトルは上で確定済みなので渡して再計算を避ける
+            pdg_result = determine_parent_id(
+                message,
+                ctx=ctx,
+                question_flag=question_flag,
+                q_vec=vector,
+                user_id=user_id,
+                session_id=session_id,
+                exclude=exclude,
+            )
             parent_id = pdg_result[0]
         except Exception as e:
             print("[PDG error]", e)
@@ -76,33 +80,250 @@ def save_chat_message_with_pdg(user_id: str, session_id: str, message: str, role
         evidence_chunks = rag_engine.search_curriculum(
             query=message,
             k=3,                 # PDG用なので少量で十分
-            threshold=0.60
+            threshold=0.60,
+            ctx=ctx,
         )
     except Exception as e:
         print("RAGエラー:", e)
         evidence_chunks = []
 
-    # ============================================
-    # Supabase 保存
-    # ============================================
-    supabase.table("haruhi_chat_logs").insert({
+    # 保存形式：ベクトルは移行済みなら圧縮列のみ（未移行は pgvector 列に配列）、
+    # エビデンスは id + 類似度のみ（読み出し時に expand_evidence_many で復元）
+    return {
+        "is_question": question_flag,
+        **vector_fields(vector),
+        "parent_id": parent_id,
+        "evidence": curriculum_refs(evidence_chunks),
+    }
+
+
+def process_pdg_job(payload: dict):
+    """
+    バックグラウンドワーカーから呼ばれる PDG ジョブ本体。
+    保存済みのユーザー行に PDG 項目を書き戻す。
+    """
+    record_id = payload["record_id"]
+    message = payload["message"]
+
+    # ライトビハインド：行がまだジャーナルにあれば DB に届くまで待つ
+    if chat_log_journal.holds(record_id):
+        raise JobDeferred(f"{record_id} not flushed yet")
+
+    # リクエスト時に生成済みの embedding を引き継ぐ
+    ctx = RequestContext(message, embedding=payload.get("question_vector"))
+    user_id = payload.get("user_id")
+    session_id = payload.get("session_id")
+    fields = compute_pdg_fields(
+        message, ctx=ctx, user_id=user_id, session_id=session_id, record_id=record_id
+    )
+
+    _update_pdg_fields(record_id, fields)
+
+    # このプロセスの PDG グラフ・問い索引にも反映（旧形式のジョブは user_id なし）
+    if user_id:
+        pdg_graph.note_parent(user_id, record_id, fields["parent_id"], fields["is_question"])
+        if stored_vector(fields):
+            question_index.add(user_id, record_id, session_id, message, stored_vector(fields))
+
+    print(f"[PDG更新完了] {record_id}")
+
+
+def sync_column_enabled() -> bool:
+    """更新時刻列が使えるか（/get_pdg_tree の since= が使えるか）"""
+    return _sync_column_enabled
+
+
+def _disable_sync_column(error: Exception) -> bool:
+    """更新時刻列がない DB のエラーなら列の記録をやめて True を返す"""
+    global _sync_column_enabled
+    if not _sync_column_enabled or PDG_SYNC_COLUMN not in str(error):
+        return False
+    print(f"[WARN] haruhi_chat_logs.{PDG_SYNC_COLUMN} not available, disabled:", error)
+    _sync_column_enabled = False
+    return True
+
+
+def _update_pdg_fields(record_id: str, fields: dict):
+    """PDG 項目を書き戻す（親の付け替えを since= で拾えるよう更新時刻も記録）"""
+    if _sync_column_enabled:
+        stamped = dict(fields)
+        stamped[PDG_SYNC_COLUMN] = datetime.utcnow().isoformat()
+        try:
+            resp = supabase.table("haruhi_chat_logs").update(stamped).eq("id", record_id).execute()
+            _require_updated(resp, record_id)
+            return
+        except Exception as e:
+            if not _disable_sync_column(e):
+                raise
+
+    resp = supabase.table("haruhi_chat_logs").update(fields).eq("id", record_id).execute()
+    _require_updated(resp, record_id)
+
+
+def _require_updated(resp, record_id: str):
+    """対象行がまだない（他プロセスのジャーナルから未送信など）なら再試行させる"""
+    if not resp.data:
+        raise RuntimeError(f"haruhi_chat_logs row {record_id} not found")
+
+
+pdg_worker.register(PDG_JOB_KIND, process_pdg_job)
+
+
+def _log_row(record_id, user_id, session_id, role, timestamp, **fields) -> dict:
+    """
+    haruhi_chat_logs の1行。一括 insert できるよう列は常に同じにそろえる。
+    """
+    row = {
         "id": record_id,
         "user_id": user_id,
         "session_id": session_id,
         "role": role,
-        "message": message,
+        "message": None,
         "response": None,
-        "is_question": question_flag,
-        "question_vector": vector,
-        "parent_id": parent_id,
-        "evidence": evidence_chunks,
-        "timestamp": datetime.utcnow().isoformat()
-    }).execute()
+        "is_question": None,
+        "question_vector": None,
+        "parent_id": None,
+        "evidence": None,
+        "timestamp": timestamp or datetime.utcnow().isoformat(),
+    }
+    if packed_column():
+        row[packed_column()] = None
+    # 追加したノードも since= で拾えるよう更新時刻を入れる
+    # （insert 直前・ライトビハインドではフラッシュ時に送信時刻で上書きする）
+    if _sync_column_enabled:
+        row[PDG_SYNC_COLUMN] = datetime.utcnow().isoformat()
+    row.update(fields)
+    return row
 
-    print(f"[PDG保存完了] {record_id}")
+
+def prepare_chat_message_with_pdg(
+    user_id: str, session_id: str, message: str, role: str, ctx=None, timestamp: str = None
+) -> dict:
+    """
+    保存する行と、insert 完了後に行う処理（PDG ジョブ投入・索引反映）を組み立てる。
+    insert 自体は行わない（save_chat_message_with_pdg / save_chat_turn が行う）。
+        {"row": 行, "after_insert": 関数, "result": 呼び出し元への戻り値}
+    """
+    record_id = str(uuid.uuid4())
+
+    # ============================================
+    # assistant（HARUHI応答）はPDG処理なし
+    # ============================================
+    if role == "assistant":
+        row = _log_row(
+            record_id, user_id, session_id, role, timestamp,
+            response=message, is_question=False,
+        )
+        return {
+            "row": row,
+            "after_insert": lambda: print(f"[PDG保存完了] {record_id}"),
+            "result": {"record_id": record_id, "session_id": session_id, "parent_id": None},
+        }
+
+    # ============================================
+    # user（質問）：バックグラウンドモード
+    #   行だけ先に保存し（is_question = NULL で PDG 未処理を表す）、
+    #   PDG 項目はワーカーが後から埋める
+    # ============================================
+    if PDG_BACKGROUND:
+        row = _log_row(record_id, user_id, session_id, role, timestamp, message=message)
+
+        def after_insert():
+            pdg_graph.note_node(user_id, row)
+            pdg_worker.submit(PDG_JOB_KIND, {
+                "record_id": record_id,
+                "user_id": user_id,
+                "session_id": session_id,
+                "message": message,
+                # リクエスト内で生成済みの embedding があれば渡して再生成を避ける
+                "question_vector": ctx.cached_embedding if ctx is not None else None,
+            })
+            print(f"[PDG保存完了] {record_id} (PDG pending)")
+
+        return {
+            "row": row,
+            "after_insert": after_insert,
+            "result": {"record_id": record_id, "session_id": session_id, "parent_id": None},
+        }
+
+    # ============================================
+    # user（質問）：同期モード
+    # ============================================
+    fields = compute_pdg_fields(
+        message, ctx=ctx, user_id=user_id, session_id=session_id, record_id=record_id
+    )
+    row = _log_row(record_id, user_id, session_id, role, timestamp, message=message, **fields)
+
+    def after_insert():
+        pdg_graph.note_node(user_id, row)
+        if stored_vector(fields):
+            question_index.add(user_id, record_id, session_id, message, stored_vector(fields))
+        print(f"[PDG保存完了] {record_id}")
 
     return {
-        "record_id": record_id,
-        "session_id": session_id,
-        "parent_id": parent_id
+        "row": row,
+        "after_insert": after_insert,
+        "result": {
+            "record_id": record_id,
+            "session_id": session_id,
+            "parent_id": fields["parent_id"],
+        },
     }
+
+
+def _insert_prepared(prepared: list):
+    """
+    組み立て済みの行を1回の一括 insert で保存し、完了後の処理を順に行う。
+    ライトビハインド有効時はローカルジャーナルへの追記で保存完了とし、
+    DB への insert はフラッシャーに任せる。
+    """
+    rows = [p["row"] for p in prepared]
+    if chat_log_journal.is_enabled():
+        chat_log_journal.append(rows)
+    else:
+        if _sync_column_enabled:
+            stamped_at = datetime.utcnow().isoformat()
+            for row in rows:
+                row[PDG_SYNC_COLUMN] = stamped_at
+        try:
+            supabase.table("haruhi_chat_logs").insert(rows).execute()
+        except Exception as e:
+            if not _disable_sync_column(e):
+                raise
+            for row in rows:
+                row.pop(PDG_SYNC_COLUMN, None)
+            supabase.table("haruhi_chat_logs").insert(rows).execute()
+    for p in prepared:
+        try:
+            p["after_insert"]()
+        except Exception as e:
+            print(f"[ERROR] after insert {p['row']['id']}:", e)
+
+
+def save_chat_message_with_pdg(user_id: str, session_id: str, message: str, role: str, ctx=None):
+    prepared = prepare_chat_message_with_pdg(user_id, session_id, message, role, ctx=ctx)
+    _insert_prepared([prepared])
+    return prepared["result"]
+
+
+def save_chat_turn(
+    user_id: str, session_id: str, user_message: str, reply: str, evidence=None, ctx=None
+):
+    """
+    1ターン分（ユーザー発話 + アシスタント応答）を1回の insert で保存する。
+    id はクライアント側で採番し、timestamp は発話 < 応答 の順になるようにする。
+    戻り値はユーザー行の save_chat_message_with_pdg と同じ形。
+    """
+    now = datetime.utcnow()
+    user_prepared = prepare_chat_message_with_pdg(
+        user_id, session_id, user_message, "user", ctx=ctx,
+        timestamp=now.isoformat(),
+    )
+    assistant_prepared = prepare_chat_message_with_pdg(
+        user_id, session_id, reply, "assistant",
+        timestamp=(now + timedelta(microseconds=1)).isoformat(),
+    )
+    assistant_prepared["row"]["evidence"] = compact_evidence(evidence)
+
+    _insert_prepared([user_prepared, assistant_prepared])
+    return user_prepared["result"]
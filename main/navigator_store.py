@@ -0,0 +1,81 @@
+# ============================================
+#  HARUHI：思考ナビゲーターの要約ストア
+# ============================================
+"""
+セッションごとに「これまでの問いの要約」と「最後に反映した問い」を保持し、
+/get_navigator_advice が新しい問いだけを GPT に渡せるようにする。
+
+- ローカル SQLite（WAL）に保存し、gunicorn の複数ワーカーで共有する。
+- 新しい問いがなければ前回の助言をそのまま返す（GPT を呼ばない）。
+"""
+
+import os
+import time
+from typing import Optional
+
+from local_store import SqliteConnections, default_path
+
+NAVIGATOR_STORE_PATH = os.getenv(
+    "NAVIGATOR_STORE_PATH", default_path("haruhi_navigator.sqlite3")
+)
+
+
+class NavigatorStore:
+
+    def __init__(self, path: str = NAVIGATOR_STORE_PATH):
+        self.path = path
+        self._db = SqliteConnections(path)
+        with self._db.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS navigator_state (
+                    session_id     TEXT PRIMARY KEY,
+                    user_id        TEXT NOT NULL,
+                    summary        TEXT NOT NULL,
+                    advice         TEXT NOT NULL,
+                    last_node_id   TEXT,
+                    last_time      TEXT,
+                    question_count INTEGER NOT NULL,
+                    updated_at     REAL NOT NULL
+                )
+                """
+            )
+
+    def get(self, session_id: str, user_id: str) -> Optional[dict]:
+        with self._db.connection() as conn:
+            row = conn.execute(
+                "SELECT summary, advice, last_node_id, last_time, question_count "
+                "FROM navigator_state WHERE session_id = ? AND user_id = ?",
+                (session_id, user_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "summary": row[0],
+            "advice": row[1],
+            "last_node_id": row[2],
+            "last_time": row[3],
+            "question_count": row[4],
+        }
+
+    def put(
+        self,
+        session_id: str,
+        user_id: str,
+        summary: str,
+        advice: str,
+        last_node_id: str,
+        last_time: str,
+        question_count: int,
+    ):
+        with self._db.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO navigator_state "
+                "(session_id, user_id, summary, advice, last_node_id, last_time, "
+                " question_count, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (session_id, user_id, summary, advice, last_node_id, last_time,
+                 question_count, time.time()),
+            )
+
+
+navigator_store = NavigatorStore()
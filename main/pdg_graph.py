@@ -0,0 +1,288 @@
+# ============================================
+#  HARUHI：PDG グラフ（ユーザー単位の隣接索引）
+# ============================================
+"""
+haruhi_chat_logs の parent_id リンクをユーザーごとにメモリ上の隣接索引として持ち、
+roots() / subtree(root, depth) / ancestors(node) を DB を引かずに返す。
+
+- 初回アクセス時にそのユーザーの発話（role = user）をページ単位で読み込む。
+- このプロセスでの保存・PDG 更新は note_node() / note_parent() で即時反映。
+- 他プロセス（gunicorn の別ワーカー）での更新は PDG_GRAPH_REFRESH_SEC ごとに
+  更新時刻列（PDG_SYNC_COLUMN）の差分で取り込む。列がない場合は全体を読み直す。
+- チャットのコンテキスト用の系譜（lineage_of）は、呼び出し側が DB から読んだ
+  最新の行を起点にし、親が手元になければその場で差分更新する。
+- 保持するユーザー数は PDG_GRAPH_USERS 件までの LRU。
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from supabase_client import supabase
+
+PDG_GRAPH_USERS = int(os.getenv("PDG_GRAPH_USERS", "256"))
+PDG_GRAPH_REFRESH_SEC = float(os.getenv("PDG_GRAPH_REFRESH_SEC", "30"))
+PDG_SYNC_COLUMN = os.getenv("PDG_SYNC_COLUMN", "updated_at")
+
+TABLE_NAME = "haruhi_chat_logs"
+NODE_COLUMNS = "id, session_id, message, parent_id, is_question, timestamp"
+PAGE_SIZE = 1000
+MAX_DEPTH = 64      # 親リンクが循環していても止まるよう上限を設ける
+
+
+def _node_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "session_id": row.get("session_id"),
+        "text": row.get("message"),
+        "parent": row.get("parent_id"),
+        "time": row.get("timestamp"),
+        # is_question が NULL → バックグラウンドの PDG 処理待ち
+        "pending": row.get("is_question") is None,
+    }
+
+
+class PdgGraph:
+    """1ユーザー分の PDG（id → ノード、親 → 子 id 一覧）"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.nodes: Dict[str, Dict[str, Any]] = {}
+        self.children: Dict[Optional[str], List[str]] = {}
+        self.synced_at: Optional[str] = None    # 差分取得の基準時刻
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    # ================================
+    # 更新
+    # ================================
+    def _unlink(self, node_id: str, parent_id):
+        siblings = self.children.get(parent_id)
+        if siblings and node_id in siblings:
+            siblings.remove(node_id)
+
+    def upsert(self, node: Dict[str, Any]):
+        old = self.nodes.get(node["id"])
+        if old is not None:
+            self._unlink(node["id"], old["parent"])
+        self.nodes[node["id"]] = node
+        self.children.setdefault(node["parent"], []).append(node["id"])
+
+    # ================================
+    # 参照
+    # ================================
+    def _root_of(self, node: Dict[str, Any]) -> bool:
+        return not node["parent"] or node["parent"] not in self.nodes
+
+    def _nested(self, node_id: str, depth: int) -> Dict[str, Any]:
+        node = self.nodes[node_id]
+        out = {
+            "id": node["id"],
+            "text": node["text"],
+            "time": node["time"],
+            "pending": node["pending"],
+            "children": [],
+        }
+        if depth > 0:
+            kids = sorted(
+                (self.nodes[c] for c in self.children.get(node_id, ()) if c in self.nodes),
+                key=lambda n: n["time"] or "",
+            )
+            out["children"] = [self._nested(k["id"], depth - 1) for k in kids]
+        return out
+
+    def roots(self, session_id: str = None) -> List[Dict[str, Any]]:
+        nodes = [
+            n for n in self.nodes.values()
+            if self._root_of(n) and (session_id is None or n["session_id"] == session_id)
+        ]
+        nodes.sort(key=lambda n: n["time"] or "")
+        return [self._nested(n["id"], 0) for n in nodes]
+
+    def subtree(self, root_id: str, depth: int = MAX_DEPTH) -> Optional[Dict[str, Any]]:
+        if root_id not in self.nodes:
+            return None
+        return self._nested(root_id, min(max(depth, 0), MAX_DEPTH))
+
+    def ancestors(self, node_id: str) -> List[Dict[str, Any]]:
+        """node_id の祖先を根から順に返す（node_id 自身は含まない）"""
+        chain = []
+        seen = {node_id}
+        node = self.nodes.get(node_id)
+        while node is not None and node["parent"] and len(chain) < MAX_DEPTH:
+            parent_id = node["parent"]
+            if parent_id in seen:
+                break
+            seen.add(parent_id)
+            node = self.nodes.get(parent_id)
+            if node is not None:
+                chain.append(node)
+        chain.reverse()
+        return chain
+
+
+class PdgGraphStore:
+    """ユーザー単位の PdgGraph を LRU で保持する"""
+
+    def __init__(self, max_users: int = PDG_GRAPH_USERS):
+        self.max_users = max_users
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+        self._sync_column = PDG_SYNC_COLUMN or None
+
+    # ================================
+    # 読み込み
+    # ================================
+    def _fetch(self, user_id: str, since: str = None) -> List[Dict[str, Any]]:
+        columns = NODE_COLUMNS
+        if since is not None:
+            columns += f", {self._sync_column}"
+
+        rows = []
+        start = 0
+        while True:
+            query = (
+                supabase.table(TABLE_NAME)
+                .select(columns)
+                .eq("user_id", user_id)
+                .eq("role", "user")
+            )
+            if since is not None:
+                query = query.gte(self._sync_column, since)
+            resp = query.order("timestamp").order("id").range(start, start + PAGE_SIZE - 1).execute()
+            page = resp.data or []
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+        return rows
+
+    def _load(self, graph: PdgGraph):
+        started = datetime.utcnow().isoformat()
+        graph.nodes.clear()
+        graph.children.clear()
+        for row in self._fetch(graph.user_id):
+            graph.upsert(_node_from_row(row))
+        graph.synced_at = started
+        graph.checked_at = time.monotonic()
+
+    def _refresh(self, graph: PdgGraph):
+        """他プロセスでの追加・親付け替えを取り込む"""
+        if self._sync_column is None:
+            self._load(graph)
+            return
+        started = datetime.utcnow().isoformat()
+        try:
+            rows = self._fetch(graph.user_id, since=graph.synced_at)
+        except Exception as e:
+            print(f"[WARN] PDG graph: sync column '{self._sync_column}' unavailable, full reload:", e)
+            self._sync_column = None
+            self._load(graph)
+            return
+        for row in rows:
+            graph.upsert(_node_from_row(row))
+        graph.synced_at = started
+        graph.checked_at = time.monotonic()
+
+    def get(self, user_id: str) -> PdgGraph:
+        with self._lock:
+            graph = self._graphs.get(user_id)
+            if graph is None:
+                graph = PdgGraph(user_id)
+                self._graphs[user_id] = graph
+            self._graphs.move_to_end(user_id)
+            while len(self._graphs) > self.max_users:
+                self._graphs.popitem(last=False)
+
+        with graph.lock:
+            if graph.synced_at is None:
+                self._load(graph)
+            elif time.monotonic() - graph.checked_at >= PDG_GRAPH_REFRESH_SEC:
+                self._refresh(graph)
+        return graph
+
+    def _loaded(self, user_id: str) -> Optional[PdgGraph]:
+        with self._lock:
+            graph = self._graphs.get(user_id)
+        if graph is None or graph.synced_at is None:
+            return None
+        return graph
+
+    # ================================
+    # このプロセスでの書き込みを反映
+    # ================================
+    def note_node(self, user_id: str, row: Dict[str, Any]):
+        """保存したユーザー行を反映（未読み込みのユーザーは何もしない）"""
+        graph = self._loaded(user_id)
+        if graph is None:
+            return
+        with graph.lock:
+            graph.upsert(_node_from_row(row))
+
+    def note_parent(self, user_id: str, node_id: str, parent_id, is_question):
+        """PDG ワーカーが書き戻した親・問い判定を反映"""
+        graph = self._loaded(user_id)
+        if graph is None:
+            return
+        with graph.lock:
+            node = graph.nodes.get(node_id)
+            if node is None:
+                return
+            node = dict(node, parent=parent_id, pending=is_question is None)
+            graph.upsert(node)
+
+    # ================================
+    # 参照（ロックを取ってから PdgGraph に委譲）
+    # ================================
+    def roots(self, user_id: str, session_id: str = None) -> List[Dict[str, Any]]:
+        graph = self.get(user_id)
+        with graph.lock:
+            return graph.roots(session_id)
+
+    def subtree(self, user_id: str, root_id: str, depth: int = MAX_DEPTH):
+        graph = self.get(user_id)
+        with graph.lock:
+            return graph.subtree(root_id, depth)
+
+    def descendants(self, user_id: str, node_id: str) -> set:
+        """node_id の子孫の id（系譜推定で自分の子孫を親にしないため）"""
+        graph = self.get(user_id)
+        with graph.lock:
+            out = set()
+            stack = list(graph.children.get(node_id, ()))
+            while stack:
+                child = stack.pop()
+                if child in out or child == node_id:
+                    continue
+                out.add(child)
+                stack.extend(graph.children.get(child, ()))
+            return out
+
+    def ancestors(self, user_id: str, node_id: str) -> List[Dict[str, Any]]:
+        graph = self.get(user_id)
+        with graph.lock:
+            return [dict(n) for n in graph.ancestors(node_id)]
+
+    def lineage_of(self, user_id: str, row: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        DB から読み直した最新の行 row を反映してから、その系譜（根 → 親）を返す。
+        親が他プロセスで追加されたばかりで手元にない場合は差分更新してから辿る。
+        haruhi_chat のコンテキストに入れる。
+        """
+        graph = self.get(user_id)
+        node = _node_from_row(row)
+        with graph.lock:
+            graph.upsert(node)
+            chain = graph.ancestors(node["id"])
+            top = chain[0] if chain else node
+            if not top["parent"] or top["parent"] in graph.nodes:
+                return [dict(n) for n in chain]
+
+            self._refresh(graph)
+            graph.upsert(node)
+            return [dict(n) for n in graph.ancestors(node["id"])]
+
+pdg_graph = PdgGraphStore()
@@ -0,0 +1,223 @@
+# ============================================
+#  HARUHI：PDG バックグラウンドワーカー
+# ============================================
+"""
+PDG 処理（問い判定・ベクトル化・系譜推論・エビデンス検索）を
+リクエストの外で実行するためのジョブキュー。
+
+- キューはローカル SQLite（WAL）に永続化する。
+  gunicorn の複数ワーカーが同じファイルを共有しても、
+  ジョブは1プロセスだけが取得（claim）する。
+- プロセスが落ちても pending / 実行中のジョブはファイルに残り、
+  次に起動したワーカーが再実行する。
+"""
+
+import os
+import json
+import time
+import threading
+
+from local_store import SqliteConnections, default_path
+
+# === 設定 ===
+QUEUE_PATH = os.getenv("PDG_QUEUE_PATH", default_path("haruhi_pdg_queue.sqlite3"))
+POLL_INTERVAL = float(os.getenv("PDG_QUEUE_POLL_SEC", "1.0"))
+MAX_ATTEMPTS = int(os.getenv("PDG_QUEUE_MAX_ATTEMPTS", "5"))
+STALE_LOCK_SEC = 600     # これ以上 running のままなら落ちたとみなして再実行
+
+
+class JobDeferred(Exception):
+    """
+    まだ実行できないジョブ（対象行が未保存など）。
+    失敗回数に数えず delay 秒後に再実行する。
+    """
+
+    def __init__(self, reason: str, delay: float = 2.0):
+        super().__init__(reason)
+        self.delay = delay
+
+
+# --------------------------------------
+# SQLite 永続キュー
+# --------------------------------------
+class SqliteJobQueue:
+    """
+    最小限の永続ジョブキュー。
+    """
+
+    def __init__(self, path: str = QUEUE_PATH):
+        self.path = path
+        self._db = SqliteConnections(path)
+        self._init_schema()
+
+    def _init_schema(self):
+        with self._db.connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind         TEXT    NOT NULL,
+                    payload      TEXT    NOT NULL,
+                    status       TEXT    NOT NULL DEFAULT 'pending',
+                    attempts     INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL    NOT NULL,
+                    locked_at    REAL,
+                    last_error   TEXT
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at)"
+            )
+
+    def _execute(self, sql: str, params=()):
+        """書き込み用（結果行は読まない）"""
+        with self._db.connection() as conn:
+            return conn.execute(sql, params)
+
+    def put(self, kind: str, payload: dict) -> int:
+        cur = self._execute(
+            "INSERT INTO jobs (kind, payload, available_at) VALUES (?, ?, ?)",
+            (kind, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        return cur.lastrowid
+
+    def claim(self):
+        """
+        実行可能なジョブを1件取得して running にする。なければ None。
+        """
+        now = time.time()
+        with self._db.transaction() as conn:
+            # 落ちたワーカーが掴んだままのジョブを戻す
+            conn.execute(
+                "UPDATE jobs SET status = 'pending' "
+                "WHERE status = 'running' AND locked_at < ?",
+                (now - STALE_LOCK_SEC,),
+            )
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts FROM jobs "
+                "WHERE status = 'pending' AND available_at <= ? "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', locked_at = ?, "
+                "attempts = attempts + 1 WHERE id = ?",
+                (now, row[0]),
+            )
+
+        return {
+            "id": row[0],
+            "kind": row[1],
+            "payload": json.loads(row[2]),
+            "attempts": row[3] + 1,
+        }
+
+    def done(self, job_id: int):
+        self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry(self, job_id: int, attempts: int, error: str):
+        """指数バックオフで再投入。上限を超えたら failed として残す。"""
+        if attempts >= MAX_ATTEMPTS:
+            self._execute(
+                "UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?",
+                (error, job_id),
+            )
+            return
+        delay = min(2 ** attempts, 300)
+        self._execute(
+            "UPDATE jobs SET status = 'pending', available_at = ?, last_error = ? "
+            "WHERE id = ?",
+            (time.time() + delay, error, job_id),
+        )
+
+    def defer(self, job_id: int, delay: float, reason: str):
+        """試行回数を戻して delay 秒後に再実行する"""
+        self._execute(
+            "UPDATE jobs SET status = 'pending', available_at = ?, last_error = ?, "
+            "attempts = MAX(attempts - 1, 0) WHERE id = ?",
+            (time.time() + delay, reason, job_id),
+        )
+
+    def pending_count(self) -> int:
+        with self._db.connection() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()
+        return row[0]
+
+
+# --------------------------------------
+# ワーカースレッド
+# --------------------------------------
+class PdgWorker:
+    """
+    キューからジョブを取り出してハンドラを実行するデーモンスレッド。
+    gunicorn の fork 後は各プロセスで start() が呼ばれた時点で起動する。
+    """
+
+    def __init__(self, queue: SqliteJobQueue):
+        self.queue = queue
+        self.handlers = {}
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def register(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def start(self):
+        with self._lock:
+            alive = self._thread is not None and self._thread.is_alive()
+            if alive and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="pdg-worker", daemon=True
+            )
+            self._thread.start()
+
+    def submit(self, kind: str, payload: dict) -> int:
+        job_id = self.queue.put(kind, payload)
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def _run(self):
+        print(f"[PDG worker] started pid={os.getpid()} queue={self.queue.path}")
+        while True:
+            try:
+                job = self.queue.claim()
+            except Exception as e:
+                print("[ERROR] PDG worker claim:", e)
+                job = None
+
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            handler = self.handlers.get(job["kind"])
+            try:
+                if handler is None:
+                    raise RuntimeError(f"unknown job kind: {job['kind']}")
+                handler(job["payload"])
+                self.queue.done(job["id"])
+            except JobDeferred as e:
+                try:
+                    self.queue.defer(job["id"], e.delay, str(e))
+                except Exception as e2:
+                    print("[ERROR] PDG worker defer:", e2)
+            except Exception as e:
+                print(f"[ERROR] PDG worker job={job['id']} attempt={job['attempts']}:", e)
+                try:
+                    self.queue.retry(job["id"], job["attempts"], str(e))
+                except Exception as e2:
+                    print("[ERROR] PDG worker retry:", e2)
+
+
+pdg_queue = SqliteJobQueue()
+pdg_worker = PdgWorker(pdg_queue)
@@ -1,14 +1,34 @@
 import os
+import time
+import hmac
+import json
+import base64
+import hashlib
+import threading
 import uuid
-from datetime import datetime
-from flask import Blueprint, request, jsonify, render_template, redirect, url_for, session
-import openai
-
-from .haruhi_rag_engine import RagEngineHARUHI
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import (
+    Blueprint, request, jsonify, render_template, redirect, url_for, session,
+    Response, stream_with_context,
+)
+
+from .haruhi_rag_engine import haruhi_engine, expand_evidence_many
 from .sakura_faq_rag_engine import RagEngineSakuraFAQ
-from .haruhi_save_with_pdg_v2 import save_chat_message_with_pdg
+from .haruhi_save_with_pdg_v2 import save_chat_turn, sync_column_enabled
+from .fanout import FanOut, Step
+from .curriculum_index import curriculum_index
+from .faq_index import faq_index, VERSION_KEY as FAQ_VERSION_KEY
+from .answer_cache import answer_cache
+from .pdg_graph import pdg_graph
+from .navigator_store import navigator_store
+from .chat_log_journal import chat_log_journal
+from .auth_cache import verify_bearer_token
+from request_context import RequestContext
+from local_store import shared_versions
 
 from supabase_client import supabase
+from openai_client import get_openai, FAST_TIMEOUT
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -25,17 +45,8 @@ def get_current_user():
     auth_header = request.headers.get("Authorization", "")
     if auth_header.startswith("Bearer "):
         token = auth_header.replace("Bearer ", "")
-        # Supabaseでトークン検証
-        import requests as req
-        res = req.get(
-            f"{os.getenv('SUPABASE_URL')}/auth/v1/user",
-            headers={
-                "Authorization": f"Bearer {token}",
-                "apikey": os.getenv("SUPABASE_KEY")
-            }
-        )
-        if res.status_code == 200:
-            return res.json().get("id")
+        # ローカルJWT検証（キャッシュ付き）→ 不可の場合のみSupabaseへ問い合わせ
+        return verify_bearer_token(token)
     return None
 
 
@@ -45,38 +56,21 @@ def require_login():
     if not user_id:
         return redirect(url_for("main.login")), None
     return None, user_id
-client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 
 # =====================================================
 # 2系統AI：HARUHI（教育RAG） & さくら（FAQ RAG）
 # =====================================================
 
-# HARUHI →　指導要領・指導案・PDG
-haruhi_engine = RagEngineHARUHI(top_k=5, threshold=0.70)
+# HARUHI →　指導要領・指導案・PDG（haruhi_rag_engine の共有インスタンス）
 
 # さくら → FAQのみ
 sakura_engine = RagEngineSakuraFAQ(top_k=3, min_score=0.30)
 
-
-# =====================================================
-# Utility：Rawログ保存
-# =====================================================
-def save_raw_log(user_id, session_id, role, message, evidence=None):
-    try:
-        supabase.table("haruhi_chat_logs").insert(
-            {
-                "user_id": user_id,
-                "session_id": session_id,
-                "role": role,
-                "message": message if role == "user" else None,
-                "response": message if role == "assistant" else None,
-                "timestamp": datetime.utcnow().isoformat(),
-                "evidence": evidence,
-            }
-        ).execute()
-    except Exception as e:
-        print("[ERROR] save_raw_log:", e)
+# 並列ステップのタイムアウト（秒）
+CONTEXT_TIMEOUT = float(os.getenv("HARUHI_CONTEXT_TIMEOUT", "5"))
+RETRIEVE_TIMEOUT = float(os.getenv("HARUHI_RETRIEVE_TIMEOUT", "15"))
+TITLE_TIMEOUT = float(os.getenv("HARUHI_TITLE_TIMEOUT", "20"))
 
 
 # =====================================================
@@ -113,11 +107,230 @@ def create_session():
     return jsonify({"session_id": session_id})
 
 
+# =====================================================
+# HARUHI チャット共通処理
+# =====================================================
+def merge_unflushed_rows(rows, session_id):
+    """
+    DB の行（古い順）に、ライトビハインドのジャーナルで未送信の行を足す。
+    送信直後で両方にある行は id で1件にまとめる。
+    """
+    if not chat_log_journal.is_enabled():
+        return rows
+    pending = chat_log_journal.pending_rows(session_id)
+    if not pending:
+        return rows
+    seen = {r.get("id") for r in rows}
+    merged = list(rows) + [r for r in pending if r["id"] not in seen]
+    merged.sort(key=lambda r: r.get("timestamp") or "")
+    return merged
+
+
+def load_recent_rows(session_id):
+    """直近3往復（6件）をDBから取得（古い順）"""
+    recent_rows = (
+        supabase.table("haruhi_chat_logs")
+        .select("id, role, message, response, parent_id, timestamp")
+        .eq("session_id", session_id)
+        .neq("role", "system")
+        .order("timestamp", desc=True)
+        .limit(6)
+        .execute()
+    )
+    rows = merge_unflushed_rows(list(reversed(recent_rows.data or [])), session_id)
+    return [r for r in rows if r.get("role") != "system"][-6:]
+
+
+def load_pdg_lineage(user_id, session_id):
+    """
+    直近ユーザー発話の PDG 系譜（根 → 親）を取得する。
+    直近の発話とその parent_id（別ワーカーの PDG ジョブが後から書く）は DB から読み直し、
+    祖先はユーザー単位の PDG グラフ（メモリ上）から辿る。
+    """
+    rows = (
+        supabase.table("haruhi_chat_logs")
+        .select("id, session_id, message, parent_id, is_question, timestamp")
+        .eq("session_id", session_id)
+        .eq("user_id", user_id)
+        .eq("role", "user")
+        .order("timestamp", desc=True)
+        .limit(1)
+        .execute()
+    ).data or []
+    rows = [r for r in merge_unflushed_rows(rows, session_id) if r.get("role", "user") == "user"]
+    if not rows:
+        return []
+    return pdg_graph.lineage_of(user_id, rows[-1])
+
+
+def build_context_messages(recent, lineage=None):
+    """
+    コンテキスト構築（PDG系譜 + 直近3往復）
+    """
+    context_messages = []
+    seen_ids = set()
+
+    for r in recent or []:
+        rid = r.get("id")
+        if rid in seen_ids:
+            continue
+        seen_ids.add(rid)
+        content = r["message"] if r["role"] == "user" else r["response"]
+        if content:
+            context_messages.append({
+                "role": r["role"],
+                "content": content
+            })
+
+    # 系譜は根から親まで1件にまとめて先頭に挿入（直近履歴にある問いは除く）
+    chain = [
+        n["text"] for n in lineage or []
+        if n.get("id") not in seen_ids and n.get("text")
+    ]
+    if len(chain) == 1:
+        context_messages.insert(0, {
+            "role": "user",
+            "content": f"[PDG親問い] {chain[0]}"
+        })
+    elif chain:
+        lines = "\n".join(f"{i}. {t}" for i, t in enumerate(chain, 1))
+        context_messages.insert(0, {
+            "role": "user",
+            "content": f"[PDG系譜]（根 → 親）\n{lines}"
+        })
+
+    print(f"[DEBUG] context_messages count: {len(context_messages)}")
+    return context_messages
+
+
+def start_chat_turn(user_id, session_id, user_message, ctx):
+    """
+    回答生成前の独立ステップを並列に開始する。
+        recent   … 直近履歴
+        lineage  … PDG系譜（根 → 親）
+        title    … セッションタイトル生成（未設定時のみ）
+        retrieve … 埋め込み + 学習指導要領RAG
+    クリティカルパスは各ステップの合計ではなく最も遅い1ステップになる。
+    """
+    return FanOut({
+        "recent": Step(load_recent_rows, session_id,
+                       timeout=CONTEXT_TIMEOUT, default=[]),
+        "lineage": Step(load_pdg_lineage, user_id, session_id,
+                        timeout=CONTEXT_TIMEOUT, default=[]),
+        "title": Step(generate_session_title, session_id, user_message,
+                      timeout=TITLE_TIMEOUT, default=None),
+        "retrieve": Step(haruhi_engine.retrieve, user_message, ctx=ctx,
+                         timeout=RETRIEVE_TIMEOUT,
+                         default=haruhi_engine.fallback_meta(user_message)),
+    })
+
+
+def persist_chat_turn(user_id, session_id, user_message, reply, rag_meta, ctx=None):
+    """
+    1ターン分の保存（ユーザー発話 + アシスタント応答）。
+    2行を1回の一括 insert で書き込む。
+    戻り値：(user_log, evidence)。user_log が None なら保存失敗。
+    """
+    evidence = {
+        "curriculum": rag_meta.get("curriculum"),
+        "lesson_plans": rag_meta.get("lesson_plans"),
+    }
+
+    # PDG保存（ユーザー発話） + アシスタント応答保存
+    user_log = save_chat_turn(
+        user_id=user_id,
+        session_id=session_id,
+        user_message=user_message,
+        reply=reply,
+        evidence=evidence,
+        ctx=ctx,
+    )
+
+    return user_log, evidence
+
+
+class TitledSessions:
+    """
+    タイトル設定済みのセッション id（LRU）。
+    2ターン目以降は haruhi_sessions を参照せずにタイトル生成を省略する。
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, session_id) -> bool:
+        with self._lock:
+            if session_id not in self._ids:
+                return False
+            self._ids.move_to_end(session_id)
+            return True
+
+    def add(self, session_id):
+        with self._lock:
+            self._ids[session_id] = True
+            self._ids.move_to_end(session_id)
+            while len(self._ids) > self.maxsize:
+                self._ids.popitem(last=False)
+
+
+titled_sessions = TitledSessions()
+
+
+def generate_session_title(session_id, user_message):
+    """
+    セッションタイトルが未設定なら最初の発話から生成する
+    """
+    if session_id in titled_sessions:
+        return
+
+    try:
+        ses = (
+            supabase.table("haruhi_sessions")
+            .select("title")
+            .eq("id", session_id)
+            .execute()
+        )
+
+        if ses.data and ses.data[0]["title"] is None:
+            title_prompt = f"次の内容を15文字以内で要約した日本語タイトルを生成：\n{user_message}"
+
+            title_res = get_openai().chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "短く簡潔なタイトルを生成する"},
+                    {"role": "user", "content": title_prompt},
+                ],
+                max_tokens=50,
+                timeout=FAST_TIMEOUT,
+            )
+
+            new_title = title_res.choices[0].message.content.strip()
+
+            supabase.table("haruhi_sessions").update(
+                {"title": new_title}
+            ).eq("id", session_id).execute()
+
+        if ses.data:
+            titled_sessions.add(session_id)
+
+    except Exception as e:
+        print("[ERROR] session title:", e)
+
+
+def _sse(event, data):
+    """Server-Sent Events の1イベント分を整形する"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
 # =====================================================
 # HARUHI（教育思考支援AI）メインチャット
 # =====================================================
 @main_bp.route("/haruhi_chat", methods=["POST"])
 def haruhi_chat():
+    fan = None
     try:
         data = request.get_json()
         user_message = data.get("message", "").strip()
@@ -130,72 +343,27 @@ def haruhi_chat():
         if session_id is None:
             return jsonify({"error": "No session"}), 400
 
+        # 発話 embedding はこのリクエスト内で1回だけ生成して共有
+        ctx = RequestContext(user_message)
+
         # --------------------------
-        # 1. コンテキスト構築（PDG親ノード + 直近3往復）
+        # 1. 独立ステップを並列実行（履歴・PDG親・タイトル・RAG検索）
         # --------------------------
-        context_messages = []
-        seen_ids = set()
+        fan = start_chat_turn(user_id, session_id, user_message, ctx)
 
-        try:
-            # ① 直近3往復（6件）をDBから取得
-            recent_rows = (
-                supabase.table("haruhi_chat_logs")
-                .select("id, role, message, response, parent_id, timestamp")
-                .eq("session_id", session_id)
-                .neq("role", "system")
-                .order("timestamp", desc=True)
-                .limit(6)
-                .execute()
-            )
-            recent = list(reversed(recent_rows.data or []))
-
-            for r in recent:
-                rid = r.get("id")
-                if rid in seen_ids:
-                    continue
-                seen_ids.add(rid)
-                content = r["message"] if r["role"] == "user" else r["response"]
-                if content:
-                    context_messages.append({
-                        "role": r["role"],
-                        "content": content
-                    })
-
-            # ② PDG親ノードを取得（直近ユーザー発話のparent_id）
-            last_user = next(
-                (r for r in reversed(recent) if r["role"] == "user"), None
-            )
-            if last_user and last_user.get("parent_id"):
-                parent_id = last_user["parent_id"]
-                if parent_id not in seen_ids:
-                    parent_row = (
-                        supabase.table("haruhi_chat_logs")
-                        .select("id, role, message, timestamp")
-                        .eq("id", parent_id)
-                        .execute()
-                    )
-                    if parent_row.data:
-                        p = parent_row.data[0]
-                        seen_ids.add(p["id"])
-                        if p.get("message"):
-                            # 親ノードは先頭に挿入（系譜の起点として）
-                            context_messages.insert(0, {
-                                "role": "user",
-                                "content": f"[PDG親問い] {p['message']}"
-                            })
-
-            print(f"[DEBUG] context_messages count: {len(context_messages)}")
-
-        except Exception as e:
-            print("[ERROR] context build:", e)
-            context_messages = []
+        # コンテキスト構築（PDG系譜 + 直近3往復）
+        context_messages = build_context_messages(
+            fan.result("recent"), fan.result("lineage")
+        )
 
         # --------------------------
         # 2. HARUHI 専用RAG
         # --------------------------
         result = haruhi_engine.answer(
             user_query=user_message,
-            context_messages=context_messages if context_messages else None
+            context_messages=context_messages if context_messages else None,
+            ctx=ctx,
+            retrieved=fan.result("retrieve"),
         )
 
         if result is None:
@@ -210,65 +378,19 @@ def haruhi_chat():
         print(rag_meta.get("lesson_plans"))
 
         # --------------------------
-        # 3. PDG保存（ユーザー発話）
+        # 3. PDG保存（ユーザー発話） + 4. アシスタント応答保存
         # --------------------------
-        user_log = save_chat_message_with_pdg(
-            user_id=user_id,
-            session_id=session_id,
-            message=user_message,
-            role="user",
+        user_log, evidence = persist_chat_turn(
+            user_id, session_id, user_message, reply, rag_meta, ctx=ctx
         )
 
         if user_log is None:
             return jsonify({"error": "PDG保存エラー"}), 500
 
         # --------------------------
-        # 4. アシスタント応答保存
-        # --------------------------
-        evidence = {
-            "curriculum": rag_meta.get("curriculum"),
-            "lesson_plans": rag_meta.get("lesson_plans"),
-        }
-
-        save_raw_log(
-            user_id=user_id,
-            session_id=session_id,
-            role="assistant",
-            message=reply,
-            evidence=evidence,
-        )
-
-        # --------------------------
-        # 5. セッションタイトル生成
+        # 5. セッションタイトル生成（並列実行済み・完了を待つ）
         # --------------------------
-        try:
-            ses = (
-                supabase.table("haruhi_sessions")
-                .select("title")
-                .eq("id", session_id)
-                .execute()
-            )
-
-            if ses.data and ses.data[0]["title"] is None:
-                title_prompt = f"次の内容を15文字以内で要約した日本語タイトルを生成：\n{user_message}"
-
-                title_res = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "短く簡潔なタイトルを生成する"},
-                        {"role": "user", "content": title_prompt},
-                    ],
-                    max_tokens=50,
-                )
-
-                new_title = title_res.choices[0].message.content.strip()
-
-                supabase.table("haruhi_sessions").update(
-                    {"title": new_title}
-                ).eq("id", session_id).execute()
-
-        except Exception as e:
-            print("[ERROR] session title:", e)
+        fan.result("title")
 
         return jsonify(
             {
@@ -282,6 +404,97 @@ def haruhi_chat():
         print("[ERROR] haruhi_chat:", e)
         return jsonify({"error": "server error"}), 500
 
+    finally:
+        # 途中で失敗した場合に未開始のステップ（タイトル生成・RAG検索）を取り消す
+        if fan is not None:
+            fan.cancel_pending()
+
+
+# =====================================================
+# HARUHI メインチャット（ストリーミング / SSE）
+# =====================================================
+@main_bp.route("/haruhi_chat_stream", methods=["POST"])
+def haruhi_chat_stream():
+    """
+    /haruhi_chat のストリーミング版。text/event-stream で以下を順に送る。
+        event: meta   … {"session_id", "evidence", "reply_mode"}（根拠・出典）
+        event: token  … {"text"}（応答テキストの差分）
+        event: done   … {"reply", "session_id"}（保存完了後）
+        event: error  … {"error"}
+    """
+    data = request.get_json() or {}
+    user_message = data.get("message", "").strip()
+    session_id = data.get("session_id")
+    user_id = get_current_user() or data.get("user_id", "guest_user")
+
+    if not user_message:
+        return jsonify({"error": "Empty message"}), 400
+
+    if session_id is None:
+        return jsonify({"error": "No session"}), 400
+
+    def generate():
+        fan = None
+        try:
+            ctx = RequestContext(user_message)
+            fan = start_chat_turn(user_id, session_id, user_message, ctx)
+            context_messages = build_context_messages(
+                fan.result("recent"), fan.result("lineage")
+            )
+
+            rag_meta = {}
+            reply = ""
+            for event, payload in haruhi_engine.answer_stream(
+                user_query=user_message,
+                context_messages=context_messages if context_messages else None,
+                ctx=ctx,
+                retrieved=fan.result("retrieve"),
+            ):
+                if event == "meta":
+                    rag_meta = payload
+                    yield _sse("meta", {
+                        "session_id": session_id,
+                        "reply_mode": payload.get("reply_mode"),
+                        "evidence": {
+                            "curriculum": payload.get("curriculum"),
+                            "lesson_plans": payload.get("lesson_plans"),
+                        },
+                    })
+                elif event == "token":
+                    yield _sse("token", {"text": payload})
+                elif event == "done":
+                    reply = payload
+
+            # ストリーム完了後に全文を保存
+            user_log, _ = persist_chat_turn(
+                user_id, session_id, user_message, reply, rag_meta, ctx=ctx
+            )
+            if user_log is None:
+                yield _sse("error", {"error": "PDG保存エラー"})
+                return
+
+            fan.result("title")
+
+            yield _sse("done", {"reply": reply, "session_id": session_id})
+
+        except Exception as e:
+            print("[ERROR] haruhi_chat_stream:", e)
+            yield _sse("error", {"error": "server error"})
+
+        finally:
+            # 失敗時・クライアント切断（GeneratorExit）時に未開始のステップを取り消す
+            if fan is not None:
+                fan.cancel_pending()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",   # リバースプロキシでのバッファリング抑止
+        },
+    )
+
 # =====================================================
 # 思考ナビゲーター
 # =====================================================
@@ -298,31 +511,69 @@ def get_navigator_advice():
         if not session_id:
             return jsonify({"error": "No session"}), 400
 
-        # セッション内のユーザー発話をPDGノードとして取得
-        rows = (
+        # 前回の要約と、最後に反映した問いの位置
+        state = navigator_store.get(session_id, user_id)
+
+        # セッション内のユーザー発話のうち、前回以降の分だけをPDGノードとして取得
+        query = (
             supabase.table("haruhi_chat_logs")
             .select("id, message, timestamp")
             .eq("session_id", session_id)
             .eq("user_id", user_id)
             .eq("role", "user")
-            .order("timestamp", desc=False)
-            .execute()
         )
+        if state and state["last_time"] and state["last_node_id"]:
+            # (timestamp, id) の keyset で前回の位置より後ろだけ
+            # （同じ timestamp の行を毎回数え直さない）
+            query = query.or_(
+                _keyset_filter("timestamp", state["last_time"], state["last_node_id"])
+            )
+        rows = query.order("timestamp", desc=False).order("id", desc=False).execute()
 
+        new_rows = rows.data or []
         pdg_nodes = []
-        for r in rows.data or []:
+        for r in new_rows:
             if r.get("message"):
                 # 変更後（カラムが存在しなくてもエラーにならない）
                 pdg_nodes.append({
                     "text": r["message"],
                 })
 
-        # 思考ナビゲーター生成
-        advice = haruhi_engine.generate_navigator_advice(pdg_nodes)
+        # 新しい問いがなければ前回の助言をそのまま返す
+        if state and not new_rows:
+            return jsonify({
+                "advice": state["advice"],
+                "question_count": state["question_count"],
+            })
+
+        if not state and not pdg_nodes:
+            return jsonify({
+                "advice": haruhi_engine.generate_navigator_advice([]),
+                "question_count": 0,
+            })
+
+        question_count = (state["question_count"] if state else 0) + len(pdg_nodes)
+
+        # 思考ナビゲーター生成（前回の要約 + 新しい問いのみ）
+        if pdg_nodes:
+            advice, summary = haruhi_engine.generate_navigator_update(
+                state["summary"] if state else None, pdg_nodes
+            )
+        else:
+            # 本文のない行だけが増えた場合は位置だけ進める
+            advice, summary = state["advice"], state["summary"]
+
+        if summary is not None:
+            navigator_store.put(
+                session_id, user_id, summary, advice,
+                last_node_id=new_rows[-1]["id"],
+                last_time=new_rows[-1]["timestamp"],
+                question_count=question_count,
+            )
 
         return jsonify({
             "advice": advice,
-            "question_count": len(pdg_nodes),
+            "question_count": question_count,
         })
 
     except Exception as e:
@@ -361,19 +612,37 @@ def sakura_faq_chat():
 # =====================================================
 @main_bp.route("/get_session_messages/<session_id>", methods=["GET"])
 def get_session_messages(session_id):
+    """
+    セッションの発話一覧。?evidence=1 でアシスタント応答の根拠
+    （保存時は id + 類似度のみ）を curriculum 行に復元して付ける。
+    """
     try:
+        with_evidence = request.args.get("evidence") == "1"
+        columns = "id, role, message, response, timestamp"
+        if with_evidence:
+            columns += ", evidence"
         rows = (
             supabase.table("haruhi_chat_logs")
-            .select("role, message, response, timestamp")
+            .select(columns)
             .eq("session_id", session_id)
             .order("timestamp", desc=False)
             .execute()
         )
+        rows = merge_unflushed_rows(rows.data or [], session_id)
+
+        evidence = [None] * len(rows)
+        if with_evidence:
+            evidence = expand_evidence_many([
+                r.get("evidence") if r["role"] == "assistant" else None for r in rows
+            ])
 
         messages = []
-        for r in rows.data:
+        for r, ev in zip(rows, evidence):
             content = r["message"] if r["role"] == "user" else r["response"]
-            messages.append({"role": r["role"], "content": content})
+            message = {"role": r["role"], "content": content}
+            if ev:
+                message["evidence"] = ev
+            messages.append(message)
 
         return jsonify({"messages": messages})
 
@@ -431,6 +700,7 @@ def update_session_title():
         supabase.table("haruhi_sessions").update(
             {"title": new_title}
         ).eq("id", session_id).execute()
+        titled_sessions.add(session_id)
 
         return jsonify({"message": "ok", "title": new_title})
 
@@ -442,17 +712,67 @@ def update_session_title():
 # =====================================================
 # FAQ一覧（さくらTOPに表示する3件）
 # =====================================================
-@main_bp.route("/get_faqs", methods=["GET"])
-def get_faqs():
-    try:
+FAQ_LIST_TTL = float(os.getenv("FAQ_LIST_TTL", "60"))   # 秒
+
+
+class FaqListCache:
+    """
+    /get_faqs の結果（全ユーザー共通）を短い TTL で保持する。
+    内容のハッシュを ETag、内容が変わった時刻を Last-Modified として返す。
+    invalidate() は共有の世代番号を進め、全ワーカーのキャッシュを無効にする。
+    """
+
+    def __init__(self, ttl: float = FAQ_LIST_TTL):
+        self.ttl = ttl
+        self._entry = None        # (expires_at, faqs, etag, last_modified, generation)
+        self._lock = threading.Lock()
+
+    def get(self):
+        generation = shared_versions.get(FAQ_VERSION_KEY)
+        with self._lock:
+            entry = self._entry
+            if entry is not None and entry[0] > time.monotonic() and entry[4] == generation:
+                return entry[1:4]
+
         rows = (
             supabase.table("haruhi_faqs")
             .select("id, question, answer, importance")
             .order("importance", desc=True)
             .limit(3)
             .execute()
-        )
-        return jsonify({"faqs": rows.data})
+        ).data or []
+        etag = hashlib.sha256(
+            json.dumps(rows, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:32]
+
+        with self._lock:
+            # 内容が同じなら Last-Modified は据え置く（ブラウザの再検証を 304 にする）
+            if self._entry is not None and self._entry[2] == etag:
+                last_modified = self._entry[3]
+            else:
+                last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+            self._entry = (time.monotonic() + self.ttl, rows, etag, last_modified, generation)
+            return rows, etag, last_modified
+
+    def invalidate(self):
+        shared_versions.bump(FAQ_VERSION_KEY)
+        with self._lock:
+            self._entry = None
+
+
+faq_list_cache = FaqListCache()
+
+
+@main_bp.route("/get_faqs", methods=["GET"])
+def get_faqs():
+    try:
+        faqs, etag, last_modified = faq_list_cache.get()
+        resp = jsonify({"faqs": faqs})
+        resp.set_etag(etag)
+        resp.last_modified = last_modified
+        # 毎回再検証させる（変化がなければ 304 で本文を送らない）
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp.make_conditional(request)
 
     except Exception as e:
         print("[ERROR] get_faqs:", e)
@@ -472,37 +792,235 @@ def index():
 # =====================================================
 # PDG Tree取得
 # =====================================================
+PDG_TREE_PAGE_SIZE = 500
+PDG_TREE_MAX_PAGE_SIZE = 1000
+PDG_SYNC_COLUMN = os.getenv("PDG_SYNC_COLUMN", "updated_at")
+
+
+def _keyset_filter(sort_column: str, sort_value: str, row_id: str) -> str:
+    """
+    (sort_column, id) が (sort_value, row_id) より後ろの行を選ぶ or_() 用フィルタ。
+    値はフィルタ文字列に埋め込むため、ISO 時刻と UUID 以外は ValueError にする。
+    """
+    datetime.fromisoformat(sort_value)
+    row_id = str(uuid.UUID(row_id))
+    return (
+        f'{sort_column}.gt."{sort_value}",'
+        f'and({sort_column}.eq."{sort_value}",id.gt.{row_id})'
+    )
+
+
+def _encode_cursor(sort_value, row_id) -> str:
+    raw = json.dumps([sort_value, row_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    """
+    next_cursor を (並び順の列の値, id) に戻す。
+    値は PostgREST の or_() フィルタ文字列に埋め込むため、
+    ISO 形式の時刻と UUID 以外は ValueError にする（フィルタ構文の注入防止）。
+    """
+    raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    sort_value, row_id = json.loads(raw)
+    if not isinstance(sort_value, str) or not isinstance(row_id, str):
+        raise ValueError("invalid cursor")
+    datetime.fromisoformat(sort_value)
+    return sort_value, str(uuid.UUID(row_id))
+
+
 @main_bp.route("/get_pdg_tree", methods=["GET"])  # ← user_idをURLから除去
 def get_pdg_tree():
+    """
+    PDGノードを (並び順の列, id) の keyset でページ単位に返す。
+        ?session_id=  … セッションで絞り込み
+        ?since=       … その時刻以降に追加・親付け替えされたノードのみ
+                         （前回レスポンスの server_time を渡す）
+        ?cursor=      … 前ページの next_cursor
+        ?limit=       … 1ページの件数（最大 PDG_TREE_MAX_PAGE_SIZE）
+    """
     user_id = get_current_user()  # ← ログイン中のユーザーIDをサーバーで取得
 
     if not user_id:
         return jsonify({"error": "unauthorized"}), 401
 
+    # 次回の since= に使う時刻（クエリ前に取る。重複は id でマージされる）
+    # 更新時刻列が使えない場合は None（クライアントは毎回全件取得する）
+    server_time = datetime.utcnow().isoformat() if sync_column_enabled() else None
+
     try:
-        rows = (
+        session_id = request.args.get("session_id")
+        since = request.args.get("since")
+        cursor = request.args.get("cursor")
+        limit = min(
+            max(int(request.args.get("limit", PDG_TREE_PAGE_SIZE)), 1),
+            PDG_TREE_MAX_PAGE_SIZE,
+        )
+        after = _decode_cursor(cursor) if cursor else None
+        if since:
+            datetime.fromisoformat(since)
+    except Exception:
+        return jsonify({"error": "invalid parameter"}), 400
+
+    # 更新時刻列がない DB では差分取得できない → クライアントに全件取得し直させる
+    if since and not sync_column_enabled():
+        return jsonify({"error": "since unsupported", "full_reload": True}), 409
+
+    # since 指定時は更新時刻順、それ以外は発話時刻順
+    sort_column = PDG_SYNC_COLUMN if since else "timestamp"
+
+    columns = "id, message, parent_id, is_question, timestamp"
+    if since:
+        columns += f", {sort_column}"
+
+    try:
+        query = (
             supabase.table("haruhi_chat_logs")
-            .select("id, message, parent_id, timestamp")
+            .select(columns)
             .eq("user_id", user_id)   # ← 認証済みuser_idでフィルタ
             .eq("role", "user")
-            .order("timestamp", desc=False)
-            .execute()
         )
+        if session_id:
+            query = query.eq("session_id", session_id)
+        if since:
+            query = query.gte(sort_column, since)
+        if after is not None:
+            query = query.or_(_keyset_filter(sort_column, *after))
+
+        rows = (
+            query.order(sort_column, desc=False)
+            .order("id", desc=False)
+            .limit(limit + 1)
+            .execute()
+        ).data or []
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = _encode_cursor(last[sort_column], last["id"])
 
         nodes = []
-        for r in rows.data:
+        for r in rows:
             nodes.append({
                 "id": r["id"],
                 "text": r["message"],
                 "parent": r["parent_id"],
-                "time": r["timestamp"]
+                "time": r["timestamp"],
+                # is_question が NULL → バックグラウンドの PDG 処理待ち
+                "pending": r.get("is_question") is None,
             })
 
-        return jsonify(nodes)
+        return jsonify({
+            "nodes": nodes,
+            "next_cursor": next_cursor,
+            "server_time": server_time,
+        })
 
     except Exception as e:
         print("[ERROR] get_pdg_tree:", e)
-        return jsonify([])
+        if since and PDG_SYNC_COLUMN in str(e):
+            return jsonify({"error": "since unsupported", "full_reload": True}), 409
+        # 空の 200 を返すとクライアントが差分なしと誤認するためエラーで返す
+        return jsonify({"error": "server error"}), 500
+
+# =====================================================
+# PDG グラフ（サーバー側で組み立てた入れ子 JSON）
+# =====================================================
+@main_bp.route("/pdg/roots", methods=["GET"])
+def pdg_roots():
+    """系譜の起点（親なし）ノード一覧。?session_id= で絞り込み"""
+    user_id = get_current_user()
+    if not user_id:
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        return jsonify({"roots": pdg_graph.roots(user_id, request.args.get("session_id"))})
+
+    except Exception as e:
+        print("[ERROR] pdg_roots:", e)
+        return jsonify({"error": "server error"}), 500
+
+
+@main_bp.route("/pdg/subtree/<node_id>", methods=["GET"])
+def pdg_subtree(node_id):
+    """node_id を根とする部分木。?depth= で深さを制限（既定は全体）"""
+    user_id = get_current_user()
+    if not user_id:
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        depth = request.args.get("depth")
+        tree = (
+            pdg_graph.subtree(user_id, node_id, int(depth))
+            if depth is not None else pdg_graph.subtree(user_id, node_id)
+        )
+        if tree is None:
+            return jsonify({"error": "not found"}), 404
+        return jsonify(tree)
+
+    except ValueError:
+        return jsonify({"error": "invalid depth"}), 400
+    except Exception as e:
+        print("[ERROR] pdg_subtree:", e)
+        return jsonify({"error": "server error"}), 500
+
+
+@main_bp.route("/pdg/ancestors/<node_id>", methods=["GET"])
+def pdg_ancestors(node_id):
+    """node_id の祖先（根 → 親の順）"""
+    user_id = get_current_user()
+    if not user_id:
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        chain = pdg_graph.ancestors(user_id, node_id)
+        return jsonify({
+            "ancestors": [
+                {"id": n["id"], "text": n["text"], "time": n["time"], "pending": n["pending"]}
+                for n in chain
+            ]
+        })
+
+    except Exception as e:
+        print("[ERROR] pdg_ancestors:", e)
+        return jsonify({"error": "server error"}), 500
+
+# =====================================================
+# 管理：学習指導要領索引の差分更新
+# =====================================================
+def _is_admin_request():
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token:
+        return False
+    return hmac.compare_digest(request.headers.get("X-Admin-Token", ""), admin_token)
+
+
+@main_bp.route("/admin/refresh_curriculum_index", methods=["POST"])
+def refresh_curriculum_index():
+    if not _is_admin_request():
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        result = curriculum_index.refresh()
+        # 根拠が変わると同じ問いでも回答が変わるため、全ワーカーの回答キャッシュを破棄
+        answer_cache.invalidate()
+        return jsonify(result)
+
+    except Exception as e:
+        print("[ERROR] refresh_curriculum_index:", e)
+        return jsonify({"error": "server error"}), 500
+
+
+@main_bp.route("/admin/invalidate_faqs", methods=["POST"])
+def invalidate_faqs():
+    """haruhi_faqs を更新した後に呼ぶ（FAQ一覧キャッシュとさくらFAQ索引を破棄）"""
+    if not _is_admin_request():
+        return jsonify({"error": "unauthorized"}), 401
+
+    faq_list_cache.invalidate()
+    faq_index.invalidate()
+    return jsonify({"status": "ok"})
 
 # =====================================================
 # ログイン画面
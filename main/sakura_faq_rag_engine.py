@@ -1,14 +1,12 @@
-import os
 from typing import List, Dict, Any
-import openai
 from supabase_client import supabase
+from embedding_service import embed_text
+from main.faq_index import faq_index
+from openai_client import get_openai, CHAT_TIMEOUT
 
 # ===============================
 # OpenAI 設定
 # ===============================
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
-
 EMBED_MODEL = "text-embedding-3-small"   # JEISI標準（1536次元）
 CHAT_MODEL = "gpt-4o-mini"               # FAQ案内は軽量モデルで十分
 
@@ -35,6 +33,8 @@ class RagEngineSakuraFAQ:
         - FAQテーブルのみ参照（haruhi_faqs）
         - JEISIの思想・使い方説明に特化
         - HARUHIの教育的RAG（指導要領/指導案）とは完全分離
+        - FAQ はプロセス内の索引（faq_index）で検索し、未読み込み時のみ RPC
+        - FAQ の質問文と一致する問いは GPT を使わず登録済みの回答を返す
     """
 
     def __init__(self, top_k=3, min_score=0.30):
@@ -49,13 +49,16 @@ class RagEngineSakuraFAQ:
         FAQテーブル（haruhi_faqs）を semantic search する。
         """
 
-        # 1. クエリ埋め込み
-        qvec = client.embeddings.create(
-            model=EMBED_MODEL,
-            input=query
-        ).data[0].embedding
+        # 1. クエリ埋め込み（キャッシュ経由）
+        qvec = embed_text(query, model=EMBED_MODEL)
+
+        # 2. ローカル索引（読み込み済みなら行列積1回）
+        if faq_index.is_enabled():
+            if faq_index.is_ready():
+                return faq_index.search(qvec, k)
+            faq_index.load_async()
 
-        # 2. Supabase RPC 呼び出し
+        # 3. Supabase RPC 呼び出し（索引の読み込み前）
         resp = supabase.rpc(
             "match_faqs",
             {"query_embedding": qvec, "match_count": k}
@@ -107,10 +110,11 @@ class RagEngineSakuraFAQ:
     # ================================
     def generate(self, messages):
         try:
-            resp = client.chat.completions.create(
+            resp = get_openai().chat.completions.create(
                 model=CHAT_MODEL,
                 messages=messages,
                 max_tokens=300,
+                timeout=CHAT_TIMEOUT,
             )
             return resp.choices[0].message.content.strip()
         except Exception as e:
@@ -125,6 +129,16 @@ class RagEngineSakuraFAQ:
         JEISI FAQ専用の軽量RAG（教育的内容は参照しない）
         """
 
+        # 0. FAQ の質問文と一致すれば登録済みの回答をそのまま返す
+        exact = faq_index.lookup_exact(user_query) if faq_index.is_enabled() else None
+        if exact is not None:
+            return exact["answer"], {
+                "used_faqs": [
+                    {"id": exact.get("id"), "question": exact.get("question"), "score": 1.0}
+                ],
+                "exact_match": True,
+            }
+
         # 1. FAQ検索
         faqs = self.search_faqs(user_query, k=self.top_k)
         faqs = [f for f in faqs if _safe_float(f.get("score")) >= self.min_score]
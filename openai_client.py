@@ -0,0 +1,71 @@
+# openai_client.py
+"""
+HARUHI - OpenAI クライアント（共通）
+各モジュールは import 時にクライアントを作らず、get_openai() で共有クライアントを使う。
+
+- 初回呼び出し時に生成する（import コストを下げる）
+- プロセス内で1つの httpx 接続プールを共有し、keep-alive で TLS ハンドシェイクを減らす
+- gunicorn の fork 後は子プロセスで作り直す（親の接続を引き継がない）
+- 失敗時の再試行（429 / 5xx / 接続エラー）は SDK の指数バックオフ＋ジッターに任せる
+- タイムアウトは呼び出しごとに timeout= で上書きできる（例：CHAT_TIMEOUT）
+"""
+
+import os
+import threading
+
+import httpx
+from openai import OpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# === 接続プール・タイムアウト設定 ===
+POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX", "32"))
+POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_KEEPALIVE", "16"))
+KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_SEC", "30"))
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+CONNECT_TIMEOUT = 5.0
+DEFAULT_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+# 用途別の呼び出しタイムアウト（秒）
+CHAT_TIMEOUT = float(os.getenv("OPENAI_CHAT_TIMEOUT", "60"))     # 応答生成
+FAST_TIMEOUT = float(os.getenv("OPENAI_FAST_TIMEOUT", "15"))     # 判定・タイトルなど短い呼び出し
+EMBED_TIMEOUT = float(os.getenv("OPENAI_EMBED_TIMEOUT", "20"))   # 埋め込み
+
+
+def _timeout(read: float) -> httpx.Timeout:
+    return httpx.Timeout(read, connect=CONNECT_TIMEOUT)
+
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def get_openai() -> OpenAI:
+    """プロセス共有の OpenAI クライアント（fork 後は作り直す）"""
+    global _client, _client_pid
+    pid = os.getpid()
+    client = _client
+    if client is not None and _client_pid == pid:
+        return client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                ),
+                timeout=_timeout(DEFAULT_TIMEOUT),
+            )
+            _client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                http_client=http_client,
+                max_retries=MAX_RETRIES,
+                timeout=_timeout(DEFAULT_TIMEOUT),
+            )
+            _client_pid = pid
+        return _client
@@ -5,19 +5,35 @@ HARUHI StandAlone（2025）仕様対応
 """
 
 import os
-from openai import OpenAI
+import re
+import random
+import threading
 from dotenv import load_dotenv
 from supabase_client import supabase
+from openai_client import get_openai, FAST_TIMEOUT
 
 from pdg_question_vectorizer_v2 import generate_question_vector
 from pdg_question_detector_v2 import is_question
+from pdg_question_index import question_index
 
 # === 環境変数 ===
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-# === 類似度閾値 ===
-SIMILARITY_THRESHOLD = 0.80
+# === 類似度閾値（3段階） ===
+#   ACCEPT 以上       → GPT なしで親と確定
+#   REJECT 未満       → GPT なしで親なし
+#   その間（中間帯）  → 上位5件の中間帯候補をまとめて1回の GPT で判定
+LINEAGE_ACCEPT_THRESHOLD = float(os.getenv("PDG_LINEAGE_ACCEPT", "0.92"))
+LINEAGE_REJECT_THRESHOLD = float(os.getenv("PDG_LINEAGE_REJECT", "0.80"))
+SIMILARITY_THRESHOLD = LINEAGE_REJECT_THRESHOLD   # 旧名（互換用）
+
+# 帯で確定した判定のうち GPT でも確認する割合（一致率の計測用、0 で無効）
+LINEAGE_AUDIT_RATE = float(os.getenv("PDG_LINEAGE_AUDIT_RATE", "0.05"))
+LINEAGE_STATS_LOG_EVERY = 50     # 何回判定するごとに統計をログ出力するか
+MATCH_COUNT = 5
+
+# 系譜検索の範囲："user"（同一ユーザーの問い）/ "session"（同一セッションのみ）
+LINEAGE_SCOPE = os.getenv("PDG_LINEAGE_SCOPE", "user")
 
 
 # --------------------------------------
@@ -46,6 +62,29 @@ NO
 """
 
 
+BATCH_CHECK_PROMPT = """
+あなたは「問いの系譜」を見極める教育AIです。
+
+新しい問いが、各候補（既存の問い）の「発展・深化・派生」に当たるかどうかを
+候補ごとに判定してください。
+
+### 新しい問い
+{new_question}
+
+### 既存の問い（候補）
+{candidates}
+
+### 判定基準
+- 論点・概念・文脈が受け継がれている場合 → YES
+- 表面的な単語一致やテーマが異なる場合 → NO
+- 無関係・異分野 → NO
+
+### 出力形式（候補の数だけ、番号順に1行ずつ）：
+1: YES
+2: NO
+"""
+
+
 def check_parent_with_gpt(parent_question: str, new_question: str) -> bool:
     """
     GPT による最終的な親子関係確認
@@ -55,82 +94,224 @@ def check_parent_with_gpt(parent_question: str, new_question: str) -> bool:
         new_question=new_question
     )
 
-    response = client.chat.completions.create(
+    response = get_openai().chat.completions.create(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "あなたは教育文脈の系譜判定AIです。"},
             {"role": "user", "content": prompt},
         ],
-        temperature=0.0
+        temperature=0.0,
+        timeout=FAST_TIMEOUT,
     )
 
     result = response.choices[0].message.content.strip()
     return result == "YES"
 
 
+def check_parents_with_gpt(parent_questions: list, new_question: str) -> list:
+    """
+    複数の候補を1回の GPT 呼び出しでまとめて判定する。
+    戻り値は候補と同じ順の bool リスト（読み取れない行は NO 扱い）。
+    """
+    if not parent_questions:
+        return []
+    if len(parent_questions) == 1:
+        return [check_parent_with_gpt(parent_questions[0], new_question)]
+
+    candidates = "\n".join(f"{i}. {q}" for i, q in enumerate(parent_questions, 1))
+    prompt = BATCH_CHECK_PROMPT.format(new_question=new_question, candidates=candidates)
+
+    response = get_openai().chat.completions.create(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "あなたは教育文脈の系譜判定AIです。"},
+            {"role": "user", "content": prompt},
+        ],
+        temperature=0.0,
+        timeout=FAST_TIMEOUT,
+    )
+
+    verdicts = [False] * len(parent_questions)
+    for line in response.choices[0].message.content.splitlines():
+        m = re.match(r"\s*(\d+)\s*[:：.）)]\s*(YES|NO)", line, re.IGNORECASE)
+        if m:
+            i = int(m.group(1)) - 1
+            if 0 <= i < len(verdicts):
+                verdicts[i] = m.group(2).upper() == "YES"
+    return verdicts
+
+
 # --------------------------------------
-# PDG v2 main：parent_id 推論 + 保存処理
+# 判定帯ごとの統計（閾値調整用）
 # --------------------------------------
-def determine_parent_id(message_text: str):
+_lineage_stats = {
+    "accept": 0,            # 高類似度帯で確定
+    "reject": 0,            # 低類似度帯で確定（候補なし含む）
+    "gpt": 0,               # 中間帯で GPT 判定
+    "gpt_yes": 0,           # 中間帯候補のうち YES
+    "gpt_no": 0,            # 中間帯候補のうち NO
+    "audit_accept": 0,      # 高類似度帯の監査件数
+    "audit_accept_agree": 0,    # うち GPT も YES
+    "audit_reject": 0,      # 低類似度帯の監査件数
+    "audit_reject_agree": 0,    # うち GPT も NO
+}
+_stats_lock = threading.Lock()
+
+
+def _count(**deltas):
+    with _stats_lock:
+        for kind, n in deltas.items():
+            _lineage_stats[kind] += n
+        decided = _lineage_stats["accept"] + _lineage_stats["reject"] + _lineage_stats["gpt"]
+    if decided and decided % LINEAGE_STATS_LOG_EVERY == 0:
+        print("[PDG lineage stats]", get_lineage_stats())
+
+
+def get_lineage_stats() -> dict:
     """
-    1) 問い判定
-    2) ベクトル生成
-    3) RPC により類似問い検索
-    4) GPT による最終確認（A案）
+    判定帯ごとの件数と、帯の判定と GPT 判定の一致率を返す。
     """
+    with _stats_lock:
+        stats = dict(_lineage_stats)
+    decided = stats["accept"] + stats["reject"] + stats["gpt"]
+    checked = stats["gpt_yes"] + stats["gpt_no"]
+    stats["total"] = decided
+    stats["gpt_rate"] = round(stats["gpt"] / decided, 3) if decided else 0.0
+    stats["mid_yes_rate"] = round(stats["gpt_yes"] / checked, 3) if checked else 0.0
+    stats["accept_agreement"] = (
+        round(stats["audit_accept_agree"] / stats["audit_accept"], 3)
+        if stats["audit_accept"] else None
+    )
+    stats["reject_agreement"] = (
+        round(stats["audit_reject_agree"] / stats["audit_reject"], 3)
+        if stats["audit_reject"] else None
+    )
+    stats["bands"] = {"accept": LINEAGE_ACCEPT_THRESHOLD, "reject": LINEAGE_REJECT_THRESHOLD}
+    return stats
 
-    # ① 問いでなければ PDG 対象外
-    if not is_question(message_text):
-        return None, 0.0, None
 
-    # ② ベクトル生成
-    q_vec = generate_question_vector(message_text)
+def _audit(kind: str, parent_question: str, new_question: str):
+    """帯で確定した判定を一定割合だけ GPT でも確認し、一致率を記録する"""
+    if LINEAGE_AUDIT_RATE <= 0 or random.random() >= LINEAGE_AUDIT_RATE:
+        return
+    try:
+        verdict = check_parent_with_gpt(parent_question, new_question)
+    except Exception as e:
+        print("[WARN] PDG lineage audit:", e)
+        return
+    if kind == "accept":
+        _count(audit_accept=1, audit_accept_agree=int(verdict))
+    else:
+        _count(audit_reject=1, audit_reject_agree=int(not verdict))
+
+
+# --------------------------------------
+# PDG v2 main：parent_id 推論 + 保存処理
+# --------------------------------------
+def find_parent_candidates(
+    q_vec: list, user_id: str = None, session_id: str = None, exclude=None
+) -> list:
+    """
+    親候補の類似問いを検索する。
+    user_id があればそのユーザーの問いだけをローカル索引で検索し、
+    ない場合（旧呼び出し）は match_questions_v2 RPC を使う。
+    exclude の id（処理中の問い自身とその子孫）は候補から外す。
+    """
+    exclude = set(exclude or ())
+    if user_id:
+        scope_session = session_id if LINEAGE_SCOPE == "session" else None
+        return question_index.search(
+            user_id, q_vec, k=MATCH_COUNT, session_id=scope_session, exclude=exclude
+        )
 
-    # ③ Supabase RPC で類似問い取得
     response = supabase.rpc(
         "match_questions_v2",
         {
             "query_embedding": q_vec,
-            "match_count": 5
+            "match_count": MATCH_COUNT + len(exclude)
         }
     ).execute()
+    return [m for m in response.data or [] if m.get("id") not in exclude]
 
-    matches = response.data or []
+
+def determine_parent_id(
+    message_text: str,
+    ctx=None,
+    question_flag: bool = None,
+    q_vec: list = None,
+    user_id: str = None,
+    session_id: str = None,
+    exclude=None,
+):
+    """
+    exclude：親にしてはいけない id（処理中の問い自身とその子孫。ジョブ再実行時に
+    自分自身が類似度 1.0 で親に選ばれるのを防ぐ）
+
+    1) 問い判定（question_flag が渡されていれば再判定しない）
+    2) ベクトル生成（q_vec / ctx があれば再利用）
+    3) 同一ユーザーの問いから類似問い検索
+    4) 類似度の3段階判定：高 → 確定 / 低 → 親なし / 中間帯のみ GPT でまとめて確認
+    """
+
+    # ① 問いでなければ PDG 対象外
+    if question_flag is None:
+        question_flag = is_question(message_text)
+    if not question_flag:
+        return None, 0.0, None
+
+    # ② ベクトル生成
+    if not q_vec:
+        q_vec = generate_question_vector(message_text, ctx=ctx)
+
+    # ③ 類似問い取得（ユーザー単位のローカル索引）
+    matches = sorted(
+        find_parent_candidates(q_vec, user_id=user_id, session_id=session_id, exclude=exclude),
+        key=lambda m: float(m["similarity"]), reverse=True,
+    )[:MATCH_COUNT]
     if not matches:
+        _count(reject=1)
         return None, 0.0, None
 
-    # 最上位候補
     top = matches[0]
-    similarity = float(top["similarity"])
-    parent_question_id = top["id"]
-    parent_question_text = top["message"]
-
-    # ④ 類似度が低い場合は親なし（新規系譜）
-    if similarity < SIMILARITY_THRESHOLD:
-        return None, similarity, None
-
-    # ⑤ GPT による最終チェック
-    is_valid = check_parent_with_gpt(
-        parent_question=parent_question_text,
-        new_question=message_text
-    )
+    top_similarity = float(top["similarity"])
+
+    # ④ 高類似度帯：GPT なしで親と確定
+    if top_similarity >= LINEAGE_ACCEPT_THRESHOLD:
+        _count(accept=1)
+        _audit("accept", top["message"], message_text)
+        return top["id"], top_similarity, top["message"]
 
-    if not is_valid:
-        return None, similarity, None
+    # ⑤ 低類似度帯：親なし（新規系譜）
+    if top_similarity < LINEAGE_REJECT_THRESHOLD:
+        _count(reject=1)
+        _audit("reject", top["message"], message_text)
+        return None, top_similarity, None
 
-    # ⑥ 親ID確定
-    return parent_question_id, similarity, parent_question_text
+    # ⑥ 中間帯：該当する候補をまとめて1回の GPT で判定
+    middle = [m for m in matches if float(m["similarity"]) >= LINEAGE_REJECT_THRESHOLD]
+    verdicts = check_parents_with_gpt([m["message"] for m in middle], message_text)
+    yes = sum(verdicts)
+    _count(gpt=1, gpt_yes=yes, gpt_no=len(verdicts) - yes)
+
+    # ⑦ YES の候補のうち最も類似度が高いものを親とする
+    for m, ok in zip(middle, verdicts):
+        if ok:
+            return m["id"], float(m["similarity"]), m["message"]
+
+    return None, top_similarity, None
 
 
 # --------------------------------------
 # 保存処理と連携するための外部IF
 # --------------------------------------
-def process_pdg_for_message(message_text: str):
+def process_pdg_for_message(message_text: str, ctx=None, user_id: str = None, session_id: str = None):
     """
     HARUHI の保存処理から利用する外部IF。
     呼び出すと parent_id 判定結果が返る。
     """
-    parent_id, similarity, parent_text = determine_parent_id(message_text)
+    parent_id, similarity, parent_text = determine_parent_id(
+        message_text, ctx=ctx, user_id=user_id, session_id=session_id
+    )
 
     return {
         "parent_id": parent_id,
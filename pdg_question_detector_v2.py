@@ -6,13 +6,66 @@ HARUHI StandAlone（2025）対応版
 """
 
 import os
-from openai import OpenAI
+import re
+import time
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
+from openai_client import get_openai, FAST_TIMEOUT
+from text_normalize import normalize_text
 
 # .env 読み込み
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# === 判定結果キャッシュ設定 ===
+DETECT_CACHE_SIZE = int(os.getenv("PDG_DETECT_CACHE_SIZE", "1024"))
+DETECT_CACHE_TTL = float(os.getenv("PDG_DETECT_CACHE_TTL", "3600"))   # 秒
+DETECT_STATS_LOG_EVERY = 100     # 何回判定するごとに内訳をログ出力するか
+
+# === ルールベース事前判定（"0" で無効化） ===
+RULE_PRECHECK_ENABLED = os.getenv("PDG_RULE_PRECHECK", "1") != "0"
+
+# 疑問詞パターン（PDG v1 pdg_question_extractor.py より）
+QUESTION_PATTERNS = [
+    r"なぜ.*",
+    r"どのように.*",
+    r"どうすれば.*",
+    r"もし.*なら.*",
+    r"何が.*",
+    r"どんな.*",
+    r"どこで.*",
+    r"誰が.*",
+    r"いつ(?!も).*",
+    r"どうして.*",
+    r"どちら.*",
+    r"どうなる.*",
+    r"何故.*",
+]
+
+# 文末マーカー（NFKC 正規化後の文字で判定。"？" → "?"）
+# 単独の「か」は「理科とか社会とか」「〜しか」などと区別できないため含めず GPT に回す
+QUESTION_ENDINGS = (
+    "?", "ですか", "ますか", "でしょうか", "だろうか", "のか", "ないか",
+    "かな", "かしら",
+)
+
+# か・かな で終わっても問いとは限らない語（静か・確か・まさか など）
+NON_QUESTION_KA_ENDINGS = (
+    "とか", "しか",
+    "静か", "確か", "僅か", "わずか", "豊か", "愚か", "おろか", "遥か", "はるか",
+    "ほのか", "にわか", "やか",   # 穏やか・鮮やか・爽やか など
+    "まさか", "ほか", "他", "なんだか", "なんとか", "何とか", "どうにか",
+    "なぜか", "何故か", "どうしてか", "どこか", "いつか", "誰か", "何か", "どれか",
+)
+
+# 命令・依頼の文末
+REQUEST_ENDINGS = (
+    "してください", "ください", "下さい", "して", "しろ", "せよ", "なさい",
+    "作って", "書いて", "まとめて", "教えて", "変換して", "生成して",
+    "ほしい", "欲しい", "お願いします", "お願い",
+)
+
+_TRAILING_PUNCT = "。．.!！ 　…"
 
 DETECT_PROMPT = """
 あなたは「問い判定AI」です。
@@ -32,28 +85,160 @@ DETECT_PROMPT = """
 "{text}"
 """
 
-def is_question(text: str) -> bool:
+# --------------------------------------
+# 判定結果キャッシュ（LRU + TTL）
+# --------------------------------------
+class DetectCache:
     """
-    GPTを用いてテキストが問いかどうか判定する
+    正規化済みテキスト → 問い判定結果 のメモ化キャッシュ。
+    同一・重複発話で GPT を2回呼ばないために使う。
     """
-    if not text:
+
+    def __init__(self, maxsize: int = DETECT_CACHE_SIZE, ttl: float = DETECT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bool):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_detect_cache = DetectCache()
+
+
+# --------------------------------------
+# ルールベース事前判定
+# --------------------------------------
+_rule_stats = {"rule_question": 0, "rule_not_question": 0, "cache": 0, "gpt": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(kind: str):
+    with _stats_lock:
+        _rule_stats[kind] += 1
+        total = sum(_rule_stats.values())
+    if total % DETECT_STATS_LOG_EVERY == 0:
+        print("[PDG detector stats]", get_detector_stats())
+
+
+def classify_by_rules(text: str):
+    """
+    ルールで確信を持って判定できる場合のみ True / False を返す。
+    判定できない（曖昧な）場合は None を返し、GPT 判定に回す。
+
+    text は normalize_text() 済みであること。
+    """
+    body = text.rstrip(_TRAILING_PUNCT)
+    if not body:
+        return None
+
+    # ① 文末マーカー（「？」「〜ですか」「〜のか」「〜かな」）
+    #    「豊かな」のように か の前が問いでない語なら対象外
+    stem = body[:-1] if body.endswith("かな") else body
+    if body.endswith(QUESTION_ENDINGS) and not stem.endswith(NON_QUESTION_KA_ENDINGS):
+        return True
+
+    has_interrogative = any(re.search(p, body) for p in QUESTION_PATTERNS)
+    is_request = body.endswith(REQUEST_ENDINGS)
+
+    # ② 疑問詞も「？」もなく依頼文末 → 問いではない
+    #    （「これはわかる？ 教えて」のように途中に「？」があれば GPT に回す）
+    if is_request and not has_interrogative and "?" not in body:
         return False
 
+    # ③ それ以外は GPT に委ねる。疑問詞があっても文末マーカーがなければ
+    #    問いとは限らない（「なぜか今日は眠い。」「どこか遠くへ行きたい。」）
+    return None
+
+
+def get_detector_stats() -> dict:
+    """
+    問い判定の内訳とルール／キャッシュのヒット率を返す。
+    """
+    with _stats_lock:
+        stats = dict(_rule_stats)
+    total = sum(stats.values())
+    rule_hits = stats["rule_question"] + stats["rule_not_question"]
+    stats["total"] = total
+    stats["rule_hit_rate"] = round(rule_hits / total, 3) if total else 0.0
+    stats["gpt_rate"] = round(stats["gpt"] / total, 3) if total else 0.0
+    return stats
+
+
+def _detect_with_gpt(text: str) -> bool:
+    """
+    GPTを用いてテキストが問いかどうか判定する（キャッシュなし）
+    """
     prompt = DETECT_PROMPT.format(text=text)
 
-    response = client.chat.completions.create(
+    response = get_openai().chat.completions.create(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "あなたは精密な問い判定AIです。"},
             {"role": "user", "content": prompt}
         ],
-        temperature=0.0
+        temperature=0.0,
+        timeout=FAST_TIMEOUT,
     )
 
     result = response.choices[0].message.content.strip()
     return result == "QUESTION"
 
 
+def is_question(text: str) -> bool:
+    """
+    テキストが問いかどうか判定する。
+    1) ルールベース事前判定（確信が持てる場合のみ）
+    2) 判定キャッシュ（正規化後に一致する発話は TTL の間再利用）
+    3) GPT 判定
+    """
+    if not text:
+        return False
+
+    key = normalize_text(text)
+    if not key:
+        return False
+
+    if RULE_PRECHECK_ENABLED:
+        ruled = classify_by_rules(key)
+        if ruled is not None:
+            _count("rule_question" if ruled else "rule_not_question")
+            return ruled
+
+    cached = _detect_cache.get(key)
+    if cached is not None:
+        _count("cache")
+        return cached
+
+    _count("gpt")
+    result = _detect_with_gpt(text)
+    _detect_cache.set(key, result)
+    return result
+
+
 if __name__ == "__main__":
     # テスト
     tests = [
@@ -66,3 +251,5 @@ if __name__ == "__main__":
 
     for t in tests:
         print(f"{t} → {is_question(t)}")
+
+    print(get_detector_stats())
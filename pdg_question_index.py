@@ -0,0 +1,245 @@
+# pdg_question_index.py
+"""
+PDG v2 - ユーザー単位の問いベクトル索引（系譜検索用）
+match_questions_v2 RPC（全ユーザー横断検索）の代わりに、
+そのユーザーの問い（haruhi_chat_logs.question_vector）だけを対象に類似検索する。
+
+- 初回検索時にユーザーの問いをページ単位で読み込み、正規化済み行列で保持する。
+  圧縮列（PDG_PACKED_VECTOR_COLUMN）があればそちらを読む。
+- 保存時に add() で追記する（このプロセスの分は即時反映）。
+- 他プロセスで保存された問いは PDG_QINDEX_REFRESH_SEC ごとに
+  更新時刻列（PDG_SYNC_COLUMN）の差分で取り込む。列がない場合は全体を読み直す。
+- 保持するユーザー数は PDG_QINDEX_USERS 件までの LRU。
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+
+from supabase_client import supabase
+from pdg_vector_codec import decode_vector as _decode, packed_column
+
+PDG_QINDEX_USERS = int(os.getenv("PDG_QINDEX_USERS", "256"))
+PDG_QINDEX_REFRESH_SEC = float(os.getenv("PDG_QINDEX_REFRESH_SEC", "30"))
+PDG_SYNC_COLUMN = os.getenv("PDG_SYNC_COLUMN", "updated_at")
+
+TABLE_NAME = "haruhi_chat_logs"
+ROW_COLUMNS = "id, session_id, message"
+PAGE_SIZE = 1000
+
+
+def decode_vector(value) -> Optional[np.ndarray]:
+    """question_vector の保存値（f32 / i8 / 配列 / JSON 文字列）を float32 配列にする"""
+    value = _decode(value)
+    if not value:
+        return None
+    return np.asarray(value, dtype=np.float32)
+
+
+def _unit(vec: np.ndarray) -> Optional[np.ndarray]:
+    norm = float(np.linalg.norm(vec))
+    if norm == 0.0:
+        return None
+    return vec / norm
+
+
+class UserQuestions:
+    """1ユーザー分の問いベクトル（行列は容量を倍々に確保して追記する）"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.rows: List[Dict[str, Any]] = []      # {"id", "session_id", "message"}
+        self.positions: Dict[str, int] = {}       # id → 行番号
+        self.matrix: Optional[np.ndarray] = None
+        self.synced_at: Optional[str] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        self.rows = []
+        self.positions = {}
+        self.matrix = None
+
+    def add(self, row_id: str, session_id: str, message: str, vector) -> bool:
+        vec = decode_vector(vector) if not isinstance(vector, np.ndarray) else vector
+        unit = _unit(vec) if vec is not None else None
+        if unit is None:
+            return False
+
+        pos = self.positions.get(row_id)
+        if pos is None:
+            pos = len(self.rows)
+            if self.matrix is None:
+                self.matrix = np.zeros((16, unit.shape[0]), dtype=np.float32)
+            elif pos >= self.matrix.shape[0]:
+                grown = np.zeros((self.matrix.shape[0] * 2, self.matrix.shape[1]), dtype=np.float32)
+                grown[:pos] = self.matrix[:pos]
+                self.matrix = grown
+            self.rows.append(None)
+            self.positions[row_id] = pos
+
+        self.rows[pos] = {"id": row_id, "session_id": session_id, "message": message}
+        self.matrix[pos] = unit
+        return True
+
+    def search(self, query_vec, k: int, session_id: str = None, exclude=None) -> List[Dict[str, Any]]:
+        """
+        match_questions_v2 と同じ形（id, message, similarity）で上位 k 件。
+        exclude の id（処理中の問い自身とその子孫）は候補にしない。
+        """
+        n = len(self.rows)
+        if n == 0 or k <= 0:
+            return []
+        unit = _unit(np.asarray(query_vec, dtype=np.float32))
+        if unit is None:
+            return []
+
+        scores = self.matrix[:n] @ unit
+        if session_id is not None:
+            mask = np.array([r["session_id"] == session_id for r in self.rows])
+            scores = np.where(mask, scores, -np.inf)
+        for row_id in exclude or ():
+            pos = self.positions.get(row_id)
+            if pos is not None:
+                scores[pos] = -np.inf
+
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        out = []
+        for i in top:
+            if not np.isfinite(scores[i]):
+                continue
+            row = self.rows[i]
+            out.append({
+                "id": row["id"],
+                "message": row["message"],
+                "similarity": float(scores[i]),
+            })
+        return out
+
+
+class QuestionIndex:
+
+    def __init__(self, max_users: int = PDG_QINDEX_USERS):
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._sync_column = PDG_SYNC_COLUMN or None
+
+    # ================================
+    # 読み込み
+    # ================================
+    def _fetch_column(self, user_id: str, column: str, since: str = None,
+                      without: str = None) -> List[Dict[str, Any]]:
+        """column にベクトルがある行を question_vector キーにそろえて返す"""
+        rows = []
+        start = 0
+        while True:
+            query = (
+                supabase.table(TABLE_NAME)
+                .select(f"{ROW_COLUMNS}, {column}")
+                .eq("user_id", user_id)
+                .eq("role", "user")
+                .eq("is_question", True)
+                .not_.is_(column, "null")
+            )
+            if without is not None:
+                query = query.is_(without, "null")
+            if since is not None:
+                query = query.gte(self._sync_column, since)
+            resp = query.order("id").range(start, start + PAGE_SIZE - 1).execute()
+            page = resp.data or []
+            for r in page:
+                r["question_vector"] = r.pop(column)
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+        return rows
+
+    def _fetch(self, user_id: str, since: str = None) -> List[Dict[str, Any]]:
+        """
+        移行済み（圧縮列あり）なら圧縮列を読み、圧縮列が空の古い行だけ
+        pgvector 列（配列、約 30KB/行）を読む。
+        """
+        column = packed_column()
+        if column is None:
+            return self._fetch_column(user_id, "question_vector", since)
+        return (
+            self._fetch_column(user_id, column, since)
+            + self._fetch_column(user_id, "question_vector", since, without=column)
+        )
+
+    def _apply(self, entry: UserQuestions, rows: List[Dict[str, Any]]):
+        for r in rows:
+            try:
+                entry.add(r["id"], r.get("session_id"), r.get("message"), r.get("question_vector"))
+            except Exception as e:
+                print(f"[WARN] question index: skip {r.get('id')}:", e)
+
+    def _load(self, entry: UserQuestions):
+        started = datetime.utcnow().isoformat()
+        entry.clear()
+        self._apply(entry, self._fetch(entry.user_id))
+        entry.synced_at = started
+        entry.checked_at = time.monotonic()
+        print(f"[INFO] question index loaded: user={entry.user_id} {len(entry.rows)} questions")
+
+    def _refresh(self, entry: UserQuestions):
+        if self._sync_column is None:
+            self._load(entry)
+            return
+        started = datetime.utcnow().isoformat()
+        try:
+            rows = self._fetch(entry.user_id, since=entry.synced_at)
+        except Exception as e:
+            print(f"[WARN] question index: sync column '{self._sync_column}' unavailable, full reload:", e)
+            self._sync_column = None
+            self._load(entry)
+            return
+        self._apply(entry, rows)
+        entry.synced_at = started
+        entry.checked_at = time.monotonic()
+
+    def _entry(self, user_id: str) -> UserQuestions:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = UserQuestions(user_id)
+                self._users[user_id] = entry
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return entry
+
+    # ================================
+    # 公開 API
+    # ================================
+    def search(self, user_id: str, query_vec, k: int = 5, session_id: str = None, exclude=None):
+        entry = self._entry(user_id)
+        with entry.lock:
+            if entry.synced_at is None:
+                self._load(entry)
+            elif time.monotonic() - entry.checked_at >= PDG_QINDEX_REFRESH_SEC:
+                self._refresh(entry)
+            return entry.search(query_vec, k, session_id=session_id, exclude=exclude)
+
+    def add(self, user_id: str, row_id: str, session_id: str, message: str, vector):
+        """保存した問いを追記（未読み込みのユーザーは初回検索時に DB から読む）"""
+        with self._lock:
+            entry = self._users.get(user_id)
+        if entry is None:
+            return
+        with entry.lock:
+            if entry.synced_at is not None:
+                entry.add(row_id, session_id, message, vector)
+
+
+question_index = QuestionIndex()
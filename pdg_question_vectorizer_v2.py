@@ -5,21 +5,18 @@ OpenAI API v1 準拠
 HARUHI StandAlone（2025）完全対応版
 """
 
-import os
-from openai import OpenAI
 from dotenv import load_dotenv
 
+from embedding_service import embed_text
+
 # .env読み込み
 load_dotenv()
 
-# OpenAIクライアント
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 # 使用する埋め込みモデル
 EMBED_MODEL = "text-embedding-3-small"
 
 
-def generate_question_vector(text: str) -> list:
+def generate_question_vector(text: str, ctx=None) -> list:
     """
     問い（テキスト）からベクトルを生成する。
     HARUHI / PDG v2 / RAG すべて共通で使用可能。
@@ -28,6 +25,8 @@ def generate_question_vector(text: str) -> list:
     ----------
     text : str
         ベクトル化したい問い文
+    ctx : RequestContext, optional
+        同一リクエスト内で生成済みの embedding があれば再利用する
 
     Returns
     -------
@@ -37,12 +36,12 @@ def generate_question_vector(text: str) -> list:
     if not text or not isinstance(text, str):
         return []
 
-    response = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=text
-    )
+    if ctx is not None:
+        shared = ctx.embedding_for(text)
+        if shared is not None:
+            return shared
 
-    return response.data[0].embedding
+    return embed_text(text, model=EMBED_MODEL)
 
 
 if __name__ == "__main__":
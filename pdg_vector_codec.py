@@ -0,0 +1,102 @@
+# pdg_vector_codec.py
+"""
+PDG v2 - question_vector の保存形式
+1536 要素の JSON 配列（約 30KB）の代わりに、バイナリを base64 文字列で保存する。
+
+    "f32:<base64>"           … float32 そのまま（約 8KB）
+    "i8:<scale>:<base64>"    … int8 量子化 + スケール（約 2KB）
+
+PDG_VECTOR_FORMAT で書き込み形式を選ぶ（既定 "json"＝従来の配列 / "f32" / "i8"）。
+読み込み（decode_vector）は形式を問わず、従来の配列・JSON 文字列も受け付ける。
+
+既定（"json"）では question_vector 列（match_questions_v2 RPC が読む pgvector 列）に
+従来どおり配列で書く。f32 / i8 は次のマイグレーションで追加した text 列に書き、
+PDG_PACKED_VECTOR_COLUMN にその列名を設定したときだけ有効になる。
+
+    alter table haruhi_chat_logs add column if not exists question_vector_packed text;
+
+移行後は question_vector を NULL にして圧縮列だけに書く（1行あたり約 30KB → 8KB / 2KB）。
+系譜検索はユーザー単位の問い索引（pdg_question_index、圧縮列を読む）で行うため、
+match_questions_v2 RPC からは移行後の行が見えなくなる。
+列名が未設定のまま f32 / i8 を指定した場合は警告を出して "json" で書く。
+"""
+
+import os
+import json
+import base64
+from array import array
+from typing import List, Optional
+
+PDG_VECTOR_FORMAT = os.getenv("PDG_VECTOR_FORMAT", "json")
+PDG_PACKED_VECTOR_COLUMN = os.getenv("PDG_PACKED_VECTOR_COLUMN", "")
+
+if PDG_VECTOR_FORMAT != "json" and not PDG_PACKED_VECTOR_COLUMN:
+    print(f"[WARN] PDG_VECTOR_FORMAT={PDG_VECTOR_FORMAT} requires PDG_PACKED_VECTOR_COLUMN, using json")
+    PDG_VECTOR_FORMAT = "json"
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def encode_vector(vector: List[float], fmt: str = None):
+    """保存用に変換する。vector が空なら None"""
+    if not vector:
+        return None
+    fmt = fmt or PDG_VECTOR_FORMAT
+
+    if fmt == "json":
+        return list(vector)
+
+    if fmt == "i8":
+        peak = max(abs(v) for v in vector)
+        scale = peak / 127.0 if peak > 0 else 1.0
+        packed = array("b", (max(-127, min(127, round(v / scale))) for v in vector))
+        return f"i8:{scale!r}:{_b64(packed.tobytes())}"
+
+    return f"f32:{_b64(array('f', vector).tobytes())}"
+
+
+def packed_column() -> Optional[str]:
+    """圧縮形式を書く列（未移行なら None）"""
+    if PDG_VECTOR_FORMAT == "json":
+        return None
+    return PDG_PACKED_VECTOR_COLUMN
+
+
+def vector_fields(vector: List[float]) -> dict:
+    """
+    haruhi_chat_logs に書く question_vector 関連の列。
+    移行済みなら圧縮列だけに書き（pgvector 列は NULL）、未移行なら pgvector 列に配列で書く。
+    """
+    column = packed_column()
+    if column:
+        return {"question_vector": None, column: encode_vector(vector)}
+    return {"question_vector": encode_vector(vector, "json")}
+
+
+def stored_vector(fields: dict):
+    """vector_fields() で作った列から保存したベクトル（圧縮列優先）を取り出す"""
+    column = packed_column()
+    if column and fields.get(column):
+        return fields[column]
+    return fields.get("question_vector")
+
+
+def decode_vector(value) -> Optional[List[float]]:
+    """保存値（f32 / i8 文字列・JSON 文字列・配列）を float のリストに戻す"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        if value.startswith("f32:"):
+            vec = array("f")
+            vec.frombytes(base64.b64decode(value[4:]))
+            return vec.tolist()
+        if value.startswith("i8:"):
+            _, scale, payload = value.split(":", 2)
+            packed = array("b")
+            packed.frombytes(base64.b64decode(payload))
+            s = float(scale)
+            return [q * s for q in packed]
+        value = json.loads(value)
+    return list(value) or None
@@ -0,0 +1,54 @@
+# request_context.py
+"""
+HARUHI - リクエストコンテキスト
+1回のユーザー発話（/haruhi_chat の1ターン）で共有する計算結果を保持する。
+
+- 発話テキストの embedding は最初に必要になった時点で1回だけ生成し、
+  RAGエンジン・PDGベクトル化・系譜推論・エビデンス検索で使い回す。
+"""
+
+from pdg_question_vectorizer_v2 import generate_question_vector
+
+
+class RequestContext:
+    """
+    1リクエスト分の共有コンテキスト
+
+    使い方：
+        ctx = RequestContext(user_message)
+        haruhi_engine.answer(user_message, ctx=ctx)
+        save_chat_message_with_pdg(..., ctx=ctx)
+    """
+
+    def __init__(self, text: str, embedding: list = None):
+        self.text = text
+        # 生成済みの embedding があれば渡せる（バックグラウンドジョブ等）
+        self._embedding = embedding or None
+
+    @property
+    def embedding(self) -> list:
+        """発話テキストの embedding（初回アクセス時のみ API を呼ぶ）"""
+        if self._embedding is None:
+            self._embedding = generate_question_vector(self.text)
+        return self._embedding
+
+    @property
+    def cached_embedding(self):
+        """生成済みの embedding（未生成なら None。API は呼ばない）"""
+        return self._embedding
+
+    def embedding_for(self, text: str):
+        """
+        text がこのリクエストの発話と同一なら共有 embedding を返す。
+        別テキストの場合は None（呼び出し側で個別に生成する）。
+        """
+        if text == self.text:
+            return self.embedding
+        return None
+
+
+def shared_embedding(ctx, text: str):
+    """ctx が None でも安全に共有 embedding を取り出すヘルパー"""
+    if ctx is None:
+        return None
+    return ctx.embedding_for(text)
@@ -36,6 +36,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
             wrapper.appendChild(inner);
             chatMessages.appendChild(wrapper);
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+            return inner;
         } else if (role === "navigator") {
             // 思考ナビゲーターメッセージ（専用スタイル）
             const wrapper = document.createElement("div");
@@ -83,6 +85,61 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    // =========================
+    // ストリーミング受信（SSE）
+    // =========================
+    async function streamChat(body, accessToken, onToken) {
+        const res = await fetch("/haruhi_chat_stream", {
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json",
+                "Authorization": `Bearer ${accessToken}`
+            },
+            body: JSON.stringify(body)
+        });
+
+        if (!res.ok || !res.body) {
+            throw new Error(`stream unavailable: ${res.status}`);
+        }
+
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let result = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // イベントは空行区切り
+            let sep;
+            while ((sep = buffer.indexOf("\n\n")) !== -1) {
+                const raw = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+
+                let event = "message";
+                let data = "";
+                raw.split("\n").forEach(line => {
+                    if (line.startsWith("event: ")) event = line.slice(7);
+                    else if (line.startsWith("data: ")) data += line.slice(6);
+                });
+                const payload = data ? JSON.parse(data) : {};
+
+                if (event === "token") {
+                    onToken(payload.text || "");
+                } else if (event === "done") {
+                    result = payload;
+                } else if (event === "error") {
+                    const err = new Error(payload.error || "stream error");
+                    err.fromServer = true;   // サーバー側で処理済み → フォールバックしない
+                    throw err;
+                }
+            }
+        }
+        return result;
+    }
+
     // =========================
     // チャット送信
     // =========================
@@ -94,29 +151,45 @@ document.addEventListener("DOMContentLoaded", () => {
         input.value = "";
 
         let sessionId = localStorage.getItem("haruhi_session_id");
+        const accessToken = sessionStorage.getItem("haruhi_access_token") || "";
+        const body = {
+            message: text,
+            session_id: sessionId,
+            user_id: userId,
+        };
 
         try {
-            const accessToken = sessionStorage.getItem("haruhi_access_token") || "";
-            const res = await fetch("/haruhi_chat", {
-                method: "POST",
-                headers: {
-                    "Content-Type": "application/json",
-                    "Authorization": `Bearer ${accessToken}`
-                },
-                body: JSON.stringify({
-                    message: text,
-                    session_id: sessionId,
-                    user_id: userId,
-                })
-            });
-
-            const data = await res.json();
+            // 応答カードを先に出し、トークンが届くたびに追記する
+            const card = appendMessage("assistant", "");
+            let streamed = "";
+            let data = null;
+
+            try {
+                data = await streamChat(body, accessToken, token => {
+                    streamed += token;
+                    card.innerText = streamed;
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                });
+            } catch (streamErr) {
+                // ストリーム自体が使えなかった場合のみ通常APIにフォールバック
+                if (streamed || streamErr.fromServer) throw streamErr;
+                console.warn("Stream fallback:", streamErr);
+                const res = await fetch("/haruhi_chat", {
+                    method: "POST",
+                    headers: {
+                        "Content-Type": "application/json",
+                        "Authorization": `Bearer ${accessToken}`
+                    },
+                    body: JSON.stringify(body)
+                });
+                data = await res.json();
+            }
 
-            if (data.session_id) {
+            if (data && data.session_id) {
                 localStorage.setItem("haruhi_session_id", data.session_id);
             }
 
-            appendMessage("assistant", data.reply);
+            card.innerHTML = data ? data.reply : streamed;
 
             // 問いカウントを増やし、3問ごとにナビゲーター自動起動
             questionCount++;
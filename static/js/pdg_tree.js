@@ -11,23 +11,64 @@ function togglePDGTree() {
     }
 }
 
+// 取得済みノード（id → node）と次回の差分取得の基準時刻
+const pdgTreeCache = { nodes: new Map(), since: null };
+
+// /get_pdg_tree をページ単位で最後まで取得する（since 指定時は差分のみ）
+async function fetchPDGTreePages(accessToken, since) {
+    const nodes = [];
+    let cursor = null;
+    let serverTime = null;
+
+    do {
+        const params = new URLSearchParams();
+        if (since) params.set("since", since);
+        if (cursor) params.set("cursor", cursor);
+
+        // ↓ URLからuser_idを除去。tokenをheaderで渡す
+        const res = await fetch(`/get_pdg_tree?${params}`, {
+            headers: {
+                "Authorization": `Bearer ${accessToken}`
+            }
+        });
+        // 409：サーバーが差分取得（since）に対応していない → 全件取得し直す
+        if (res.status === 409 && since) return fetchPDGTreePages(accessToken, null);
+        if (!res.ok) throw new Error(`get_pdg_tree ${res.status}`);
+        const page = await res.json();
+
+        nodes.push(...(page.nodes || []));
+        cursor = page.next_cursor;
+        serverTime = serverTime || page.server_time;
+    } while (cursor);
+
+    return { nodes, serverTime, full: !since };
+}
+
 // ↓ userId引数を廃止。Authorization headerでサーバーに認証させる
 async function loadPDGTree() {
     const container = document.getElementById("pdg-tree-content");
     if (!container) return;
 
-    container.innerHTML = "<p style='color:#aaa;font-size:13px;padding:12px'>読み込み中...</p>";
+    if (pdgTreeCache.nodes.size === 0) {
+        container.innerHTML = "<p style='color:#aaa;font-size:13px;padding:12px'>読み込み中...</p>";
+    }
 
-    // ↓ URLからuser_idを除去。tokenをheaderで渡す
     const accessToken = sessionStorage.getItem("haruhi_access_token") || "";
-    const res = await fetch(`/get_pdg_tree`, {
-        headers: {
-            "Authorization": `Bearer ${accessToken}`
-        }
-    });
-    const nodes = await res.json();
+    try {
+        // 2回目以降は前回以降に追加・親付け替えされたノードだけを取得してマージ
+        const { nodes: changed, serverTime, full } =
+            await fetchPDGTreePages(accessToken, pdgTreeCache.since);
+        if (full) pdgTreeCache.nodes.clear();
+        changed.forEach(n => pdgTreeCache.nodes.set(n.id, n));
+        pdgTreeCache.since = serverTime || null;
+    } catch (e) {
+        console.error("loadPDGTree error:", e);
+    }
 
-    if (!nodes || nodes.length === 0) {
+    const nodes = Array.from(pdgTreeCache.nodes.values())
+        .sort((a, b) => (a.time || "").localeCompare(b.time || ""));
+
+    if (nodes.length === 0) {
         container.innerHTML = "<p style='color:#aaa;font-size:13px;padding:12px'>まだ問いの系譜がありません</p>";
         return;
     }
@@ -101,7 +142,10 @@ function renderPDGTree(nodes, container) {
 
     node.append("circle")
         .attr("r", 10)
-        .attr("fill", d => d.parent?.data.id === "__root__" ? "#7c3aed" : "#3b82f6")
+        .attr("fill", d => {
+            if (d.data.pending) return "#cbd5e1";   // PDG解析待ち
+            return d.parent?.data.id === "__root__" ? "#7c3aed" : "#3b82f6";
+        })
         .attr("stroke", "#fff")
         .attr("stroke-width", 2.5);
 
@@ -159,6 +203,9 @@ function renderPDGTree(nodes, container) {
             if (count > 1) {
                 html += `<br><span style="color:#fca5a5">⚠ 同じ問いが系譜内に ${count} 件あります</span>`;
             }
+            if (d.data.pending) {
+                html += `<br><span style="color:#cbd5e1">⏳ 系譜を解析中です</span>`;
+            }
             html += `<br><span style="color:#a5b4fc">深さ: ${depth} 階層</span>`;
             if (d.children && d.children.length > 0) {
                 html += `<br><span style="color:#6ee7b7">派生: ${d.children.length} 問い</span>`;
@@ -1,5 +1,6 @@
 from supabase import create_client, Client
 import os
+import threading
 from dotenv import load_dotenv
 
 # .env を読み込む（Flask起動前でも確実に反映）
@@ -9,8 +10,54 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 
+# PostgREST 呼び出しのタイムアウト（秒）
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("⚠️ SUPABASE_URL または SUPABASE_KEY が読み込めていません。 .env の場所と内容を確認してください。")
 
-# サーバー側の書き込みはRLSを無視できるService Roleキーを使用
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY or SUPABASE_KEY)
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+def _create() -> Client:
+    try:
+        from supabase import ClientOptions
+        options = ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT)
+    except ImportError:     # 古い supabase-py では既定値のまま
+        options = None
+    # サーバー側の書き込みはRLSを無視できるService Roleキーを使用
+    key = SUPABASE_SERVICE_KEY or SUPABASE_KEY
+    if options is None:
+        return create_client(SUPABASE_URL, key)
+    return create_client(SUPABASE_URL, key, options=options)
+
+
+def get_supabase() -> Client:
+    """
+    プロセス共有の Supabase クライアント。
+    初回利用時に生成し、gunicorn の fork 後は子プロセスで作り直す。
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    client = _client
+    if client is not None and _client_pid == pid:
+        return client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            _client = _create()
+            _client_pid = pid
+        return _client
+
+
+class _LazySupabase:
+    """`from supabase_client import supabase` のまま使えるよう get_supabase() に委譲する"""
+
+    def __getattr__(self, name):
+        return getattr(get_supabase(), name)
+
+
+supabase: Client = _LazySupabase()
@@ -0,0 +1,28 @@
+# text_normalize.py
+"""
+HARUHI - 問い・発話テキストの正規化（共通）
+キャッシュキー（埋め込みキャッシュ・問い判定キャッシュ）と
+FAQ の完全一致判定はすべてこのモジュールの関数を使う。
+モジュールごとに正規化がずれると同じ発話が別のキーになるため、個別に実装しないこと。
+"""
+
+import re
+import unicodedata
+
+# 完全一致判定で無視する文末の記号（NFKC 後の文字）
+_TRAILING_MARKS = "?？!！。.、"
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用の正規化（全角半角・空白の揺れを吸収）"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def normalize_question(text: str) -> str:
+    """
+    完全一致判定用の正規化。normalize_text() に加えて
+    大文字小文字・空白の有無・末尾の記号の違いも吸収する。
+    """
+    text = normalize_text(text).lower().replace(" ", "")
+    return text.rstrip(_TRAILING_MARKS)